@@ -0,0 +1,72 @@
+// SPDX-License-Identifier: AGPL-3.0-Only OR CERN-OHL-S-2.0
+/*
+ * Copyright (C) 2023 Sean Anderson <seanga2@gmail.com>
+ */
+
+/*
+ * A clock enable generator for testbenches. It is configured over VPI (see
+ * ClockEnable in tb/util.py). When enable is set, ce is high step times every
+ * ratio cycles, spread out as evenly as possible. Otherwise, it is held at
+ * hold. count is a phase accumulator which advances by step every cycle; ce
+ * goes high whenever it wraps around ratio.
+ */
+module clock_enable (
+	input clk,
+	output ce
+);
+
+	reg attach, enable, hold, strobe;
+	integer ratio, step, count;
+
+	initial begin
+		attach = 0;
+		enable = 0;
+		hold = 0;
+		strobe = 0;
+		ratio = 1;
+		step = 1;
+		count = 0;
+	end
+
+	assign ce = enable ? strobe : hold;
+
+	always @(posedge clk) begin
+		if (count + step >= ratio) begin
+			strobe <= 1;
+			count <= count + step - ratio;
+		end else begin
+			strobe <= 0;
+			count <= count + step;
+		end
+	end
+
+endmodule
+
+/*
+ * Drive the inputs of `TOP named by `CLOCK_ENABLE1 through `CLOCK_ENABLE4 with
+ * clock enable generators. Each generator has the same name as its input, and
+ * only takes over the input while it is attached.
+ */
+`define CLOCK_ENABLE(name) \
+	clock_enable name ( \
+		.clk(`TOP.clk) \
+	); \
+	always @(posedge name.attach) \
+		force `TOP.name = name.ce; \
+	always @(negedge name.attach) \
+		release `TOP.name;
+
+module clock_enables();
+`ifdef CLOCK_ENABLE1
+	`CLOCK_ENABLE(`CLOCK_ENABLE1)
+`endif
+`ifdef CLOCK_ENABLE2
+	`CLOCK_ENABLE(`CLOCK_ENABLE2)
+`endif
+`ifdef CLOCK_ENABLE3
+	`CLOCK_ENABLE(`CLOCK_ENABLE3)
+`endif
+`ifdef CLOCK_ENABLE4
+	`CLOCK_ENABLE(`CLOCK_ENABLE4)
+`endif
+endmodule
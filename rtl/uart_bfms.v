@@ -0,0 +1,111 @@
+// SPDX-License-Identifier: AGPL-3.0-Only OR CERN-OHL-S-2.0
+/*
+ * Copyright (C) 2023 Sean Anderson <seanga2@gmail.com>
+ */
+
+`include "common.vh"
+
+/*
+ * A UART transmitter for testbenches. It is configured over VPI (see
+ * UARTSource in tb/uart_rx.py). Each time start toggles, the first bits bits
+ * of frame (including start and stop bits) are sent on tx, LSB first. Each bit
+ * lasts period time units (ns, from the timescale in common.vh). Bit edges are
+ * calculated from the start of the frame, so periods which aren't a whole
+ * number of ns don't accumulate rounding errors. done toggles once the frame
+ * has been sent.
+ */
+module uart_source (
+	output reg tx
+);
+
+	reg attach, start, done;
+	reg [31:0] frame;
+	integer bits, i;
+	real period, t0;
+
+	initial begin
+		attach = 0;
+		start = 0;
+		done = 0;
+		tx = 1;
+		frame = 0;
+		bits = 0;
+		period = 0;
+	end
+
+	always @(start) begin
+		t0 = $realtime;
+		for (i = 0; i < bits; i = i + 1) begin
+			tx = frame[i];
+			#(t0 + (i + 1) * period - $realtime);
+		end
+		done = !done;
+	end
+
+endmodule
+
+/*
+ * A UART receiver for testbenches (see UARTSink in tb/uart_tx.py). Once
+ * enabled, it waits for a start bit on rx and samples each bit in the middle.
+ * data holds the last frame's data, and frame_error is set if any of its
+ * stop_bits stop bits were low. done toggles after each frame.
+ */
+module uart_sink (
+	input rx
+);
+
+	reg enable, done, frame_error;
+	reg [7:0] data;
+	integer stop_bits, i;
+	real period, t0;
+
+	initial begin
+		enable = 0;
+		done = 0;
+		frame_error = 0;
+		data = 0;
+		stop_bits = 1;
+		period = 0;
+	end
+
+	always begin
+		wait (enable);
+		@(negedge rx);
+		t0 = $realtime;
+		for (i = 0; i < 8; i = i + 1) begin
+			#(t0 + (i + 1.5) * period - $realtime);
+			data = { rx, data[7:1] };
+		end
+
+		frame_error = 0;
+		for (i = 0; i < stop_bits; i = i + 1) begin
+			#(t0 + (i + 9.5) * period - $realtime);
+			if (!rx)
+				frame_error = 1;
+		end
+		done = !done;
+	end
+
+endmodule
+
+/*
+ * Connect a uart_source to `TOP.`UART_SOURCE, and a uart_sink to
+ * `TOP.`UART_SINK. Each is named after the signal it is connected to, which is
+ * how tb/uart_rx.py finds them. The source only takes over its input while it
+ * is attached.
+ */
+module uart_bfms();
+`ifdef UART_SOURCE
+	uart_source `UART_SOURCE ();
+
+	always @(posedge `UART_SOURCE.attach)
+		force `TOP.`UART_SOURCE = `UART_SOURCE.tx;
+	always @(negedge `UART_SOURCE.attach)
+		release `TOP.`UART_SOURCE;
+`endif
+`ifdef UART_SINK
+	uart_sink `UART_SINK (
+		.rx(`TOP.`UART_SINK)
+	);
+`endif
+endmodule
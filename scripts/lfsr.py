@@ -2,7 +2,10 @@
 # SPDX-License-Identifier: AGPL-3.0-Only
 # Copyright (C) 2023 Sean Anderson <seanga2@gmail.com>
 
+import argparse
 import functools
+import json
+import os
 import sys
 
 def logbits(x):
@@ -13,39 +16,250 @@ def logbits(x):
         b += 1
         x >>= 1
 
+def parse_taps(taps):
+    return tuple(reversed(tuple(logbits(taps))))
+
+# Transpose a list of integers into a list of width integers, where bit n of
+# slice i is bit i of values[n]. This lets us step many LFSRs at once.
+def bitslice(values, width):
+    if not values:
+        return [0] * width
+    strs = (format(value, f"0{width}b") for value in values)
+    return [int(''.join(lane)[::-1], 2) for lane in reversed(tuple(zip(*strs)))]
+
+def unbitslice(slices, count):
+    strs = (format(s, f"0{count}b") for s in reversed(slices))
+    return [int(''.join(lane), 2) for lane in reversed(tuple(zip(*strs)))]
+
+class LFSR:
+    def __init__(self, taps, cache=None):
+        self.taps = tuple(sorted(taps, reverse=True))
+        self.width = self.taps[0] + 1
+        self.max_cycles = (1 << self.width) - 1
+        self.mask = sum(1 << tap for tap in self.taps)
+        self.key = hex(self.mask)
+        # Each matrix holds the state after 2^k steps from each single-bit
+        # state (i.e. its columns)
+        self.matrices = [tuple((bit < self.taps[0]) << (bit + 1) | (bit in self.taps)
+                               for bit in range(self.width))]
+        self.baby = None
+        self.giant = None
+        self.cache = cache
+        self.dirty = False
+        if cache is not None:
+            self.load()
+
+    def load(self):
+        try:
+            with open(self.cache) as f:
+                tables = json.load(f).get(self.key, {})
+        except FileNotFoundError:
+            return
+
+        matrices = tables.get('matrices', ())
+        if len(matrices) > len(self.matrices):
+            self.matrices = [tuple(matrix) for matrix in matrices]
+
+    def save(self):
+        if self.cache is None or not self.dirty:
+            return
+
+        try:
+            with open(self.cache) as f:
+                tables = json.load(f)
+        except FileNotFoundError:
+            tables = {}
+
+        tables.setdefault(self.key, {})['matrices'] = self.matrices
+        with open(self.cache + '.tmp', 'w') as f:
+            json.dump(tables, f)
+        os.replace(self.cache + '.tmp', self.cache)
+        self.dirty = False
+
+    def matrix(self, logsteps):
+        while len(self.matrices) <= logsteps:
+            last = self.matrices[-1]
+            self.matrices.append(tuple(self.apply(last, column) for column in last))
+            self.dirty = True
+        return self.matrices[logsteps]
+
+    @staticmethod
+    def apply(matrix, state):
+        lfsr = 0
+        for bit in logbits(state):
+            lfsr ^= matrix[bit]
+        return lfsr
+
+    def next(self, state):
+        feedback = (state & self.mask).bit_count() & 1
+        return (state << 1 | feedback) & self.max_cycles
+
+    def step(self, state, steps):
+        for logsteps in logbits(steps):
+            state = self.apply(self.matrix(logsteps), state)
+        return state
+
+    def step_many(self, states, steps):
+        steps = list(steps)
+        if not steps:
+            return []
+        logsteps = max(steps).bit_length()
+        states = bitslice(list(states), self.width)
+        masks = bitslice(steps, logsteps)
+
+        for k, mask in enumerate(masks):
+            matrix = self.matrix(k)
+            rows = [sum(((column >> row) & 1) << bit for bit, column in enumerate(matrix))
+                    for row in range(self.width)]
+            stepped = [0] * self.width
+            for row, bits in enumerate(rows):
+                for bit in logbits(bits):
+                    stepped[row] ^= states[bit]
+            states = [new & mask | old & ~mask for new, old in zip(stepped, states)]
+        return unbitslice(states, len(steps))
+
+    # The next length bits shifted into the LFSR, packed with the first bit in
+    # the LSB. Each bit is the sum of the bits (tap + 1) before it. Squaring
+    # the polynomial doubles those distances, so we can extend the known part
+    # of the sequence by many bits with a single shift per tap.
+    def sequence(self, state, length):
+        seq = int(format(state, f"0{self.width}b")[::-1], 2)
+        known = self.width
+        while known < self.width + length:
+            dist = 1 << (known // self.width).bit_length() - 1
+            new = 0
+            for tap in self.taps:
+                new ^= seq >> known - (tap + 1) * dist
+            span = (self.taps[-1] + 1) * dist
+            seq |= (new & ((1 << span) - 1)) << known
+            known += span
+        return seq >> self.width & ((1 << length) - 1)
+
+    # A list of count consecutive states, starting start steps after state. By
+    # default, this is the whole sequence.
+    def states(self, state, count=None, start=0):
+        if count is None:
+            count = self.max_cycles
+        state = self.step(state, start)
+        seq = format(state, f"0{self.width}b")
+        if count > 1:
+            seq += format(self.sequence(state, count - 1), f"0{count - 1}b")[::-1]
+        return [int(seq[t:t + self.width], 2) for t in range(count)]
+
+    # The state to load so that we go through cycles states before reaching
+    # all ones
+    def start_state(self, cycles):
+        return self.step(self.max_cycles, self.max_cycles - cycles + 1)
+
+    def start_states(self, cycles):
+        steps = [self.max_cycles - c + 1 for c in cycles]
+        return self.step_many((self.max_cycles,) * len(steps), steps)
+
+    # Tables for a baby-step/giant-step search. The baby steps are the first
+    # sqrt(max_cycles) states after all ones. The giant step goes back that
+    # many states, using one lookup table per byte of the state.
+    def log_tables(self):
+        if self.baby is None:
+            m = 1 << (self.width + 1) // 2
+            self.baby = {}
+            state = self.max_cycles
+            for j in range(m):
+                self.baby.setdefault(state, j)
+                state = self.next(state)
+
+            columns = [self.step(1 << bit, self.max_cycles - m) for bit in range(self.width)]
+            self.giant = []
+            for bit in range(0, self.width, 8):
+                chunk = columns[bit:bit + 8]
+                self.giant.append([self.apply(chunk, byte) for byte in range(1 << len(chunk))])
+        return self.baby, self.giant
+
+    # Find how many steps it takes to get to state from all ones. Like
+    # start_state, this assumes the LFSR is maximal-length.
+    def log(self, state):
+        if not 0 < state <= self.max_cycles:
+            raise ValueError(f"{state:#x} is not a state of this LFSR")
+
+        baby, giant = self.log_tables()
+        value = state
+        for i in range(self.max_cycles // len(baby) + 1):
+            j = baby.get(value)
+            if j is not None:
+                return (i * len(baby) + j) % self.max_cycles
+
+            stepped = 0
+            for chunk, table in enumerate(giant):
+                stepped ^= table[value >> chunk * 8 & 0xff]
+            value = stepped
+        raise ValueError(f"{state:#x} is not a state of this LFSR")
+
+    # The inverse of start_state: the number of states left (including this
+    # one) before reaching all ones
+    def cycles(self, state):
+        return (self.max_cycles - self.log(state)) % self.max_cycles + 1
+
 @functools.cache
+def get_lfsr(taps):
+    return LFSR(taps)
+
 def logstep_bit(taps, bit, logsteps):
-    if not logsteps:
-        return (bit < taps[0]) << (bit + 1) | (bit in taps)
-    return logstep_state(taps, logstep_bit(taps, bit, logsteps - 1), logsteps - 1)
+    return get_lfsr(taps).matrix(logsteps)[bit]
 
 def logstep_state(taps, state, logsteps):
-    lfsr = 0
-    for bit in logbits(state):
-        lfsr ^= logstep_bit(taps, bit, logsteps)
-    return lfsr
+    return LFSR.apply(get_lfsr(taps).matrix(logsteps), state)
 
 def step_state(taps, state, steps):
-    for logsteps in logbits(steps):
-        state = logstep_state(taps, state, logsteps)
-    return state
+    return get_lfsr(taps).step(state, steps)
+
+# Answer many (taps, cycles) queries with start states, batching the queries
+# for each set of taps together
+def start_states(queries, cache=None):
+    queries = list(queries)
+    groups = {}
+    for i, (taps, cycles) in enumerate(queries):
+        groups.setdefault(tuple(taps), []).append(i)
+
+    states = [None] * len(queries)
+    for taps, indices in groups.items():
+        lfsr = get_lfsr(taps) if cache is None else LFSR(taps, cache)
+        for i, state in zip(indices, lfsr.start_states(queries[i][1] for i in indices)):
+            states[i] = state
+        lfsr.save()
+    return states
+
+def sequence(taps, state, length):
+    return get_lfsr(taps).sequence(state, length)
 
 if __name__ == '__main__':
-    if len(sys.argv) < 2:
-        print(f"""Usage: {sys.argv[0]} TAPS CYCLES...
-Calculate the starting state to use with the LFSR defined by TAPS (as an
-integer) which will go through CYCLES states before finishing.""", file=sys.stderr)
-        sys.exit(1)
-
-    taps = tuple(reversed(tuple(logbits(int(sys.argv[1], base=0)))))
-    max_cycles = (1 << taps[0] + 1) - 1
-    for cycles in sys.argv[2:]:
-        cycles = int(cycles, base=0)
-        if cycles > max_cycles:
-            print(f"Maximum cycles is {max_cycles:#x}, got {cycles:#x}",
+    parser = argparse.ArgumentParser(description="""Calculate the starting state
+to use with the LFSR defined by TAPS (as an integer) which will go through
+CYCLES states before finishing.""")
+    parser.add_argument('taps', metavar='TAPS', type=lambda x: int(x, base=0))
+    parser.add_argument('cycles', metavar='CYCLES', nargs='*',
+                        type=lambda x: int(x, base=0))
+    parser.add_argument('-c', '--cache', metavar='FILE',
+                        help="Cache transition matrices in FILE")
+    parser.add_argument('-s', '--states', action='store_true',
+                        help="Treat CYCLES as states, and calculate how many cycles they have left")
+    args = parser.parse_intermixed_args()
+
+    lfsr = LFSR(parse_taps(args.taps), args.cache)
+    if args.states:
+        for state in args.cycles:
+            try:
+                print(lfsr.cycles(state))
+            except ValueError as e:
+                print(e, file=sys.stderr)
+        sys.exit()
+
+    states = iter(lfsr.start_states(cycles for cycles in args.cycles
+                                    if 0 < cycles <= lfsr.max_cycles))
+    for cycles in args.cycles:
+        if cycles > lfsr.max_cycles:
+            print(f"Maximum cycles is {lfsr.max_cycles:#x}, got {cycles:#x}",
                   file=sys.stderr)
         elif cycles <= 0:
             print(f"Minimum cycles is 1, got {cycles}", file=sys.stderr)
         else:
-            state = step_state(taps, max_cycles, max_cycles - cycles + 1)
-            print(f"{taps[0] + 1}'h{state:0{(taps[0] + 4) // 4}x}")
+            print(f"{lfsr.width}'h{next(states):0{(lfsr.width + 3) // 4}x}")
+    lfsr.save()
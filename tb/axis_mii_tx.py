@@ -1,6 +1,7 @@
 # SPDX-License-Identifier: AGPL-3.0-Only
 # Copyright (C) 2022 Sean Anderson <seanga2@gmail.com>
 
+import collections
 import enum
 import random
 import zlib
@@ -9,12 +10,12 @@ import cocotb
 from cocotb.binary import BinaryValue
 from cocotb.clock import Clock
 from cocotb.regression import TestFactory
-from cocotb.triggers import ClockCycles, Edge, FallingEdge, First, RisingEdge, Timer
+from cocotb.triggers import ClockCycles, Edge, Event, FallingEdge, First, RisingEdge, Timer
 from cocotb.utils import get_sim_time, get_sim_steps
 
 from . import axis_replay_buffer
 from .pcs_rx import mii_recv_packet
-from .util import alist, lookahead, timeout
+from .util import AXISBus, MIIBus, timeout
 
 import os
 
@@ -37,15 +38,11 @@ async def init(mac):
         mac.rst.value = 0
     await cocotb.start(_init())
 
+    monitor = monitors[mac] = StatusMonitor(mac)
+    return monitor
+
 def send_packet(mac, packet, **kwargs):
-    return axis_replay_buffer.send_packet({
-        'clk': mac.clk,
-        'data': mac.axis_data,
-        'err': mac.axis_err,
-        'valid': mac.axis_valid,
-        'last': mac.axis_last,
-        'ready': mac.axis_ready,
-    }, packet, **kwargs)
+    return axis_replay_buffer.send_packet(AXISBus(mac, 'axis_'), packet, **kwargs)
 
 class MACError(Exception):
     pass
@@ -59,47 +56,82 @@ class AlignmentError(MACError):
 class PaddingError(MACError):
     pass
 
-async def nibbles_to_bytes(nibbles):
-    while True:
-        try:
-            lo = await anext(nibbles)
-        except StopAsyncIteration:
-            return
-
-        try:
-            hi = await anext(nibbles)
-        except StopAsyncIteration:
-            raise AlignmentError
-
-        yield hi << 4 | lo
-
 SFD = 0xd5
+FCS_GOOD = zlib.crc32(b'\0\0\0\0')
 
-async def skip_preamble(packet):
-    saw_ssd = False
-    async for byte in packet:
-        if saw_ssd:
-            yield byte
-        elif byte == SFD:
-            saw_ssd = True
+# Check frames as their nibbles arrive. Bytes are folded into a running CRC
+# every BLOCK bytes, so memory is bounded unless the frame data is kept.
+class FCSChecker:
+    BLOCK = 256
+
+    def __init__(self, keep=True):
+        self.keep = keep
+        self.frames = 0
+        self.fcs_errors = 0
+        self.alignment_errors = 0
+        self.padding_errors = 0
+        self.reset()
+
+    def reset(self):
+        self.crc = 0
+        self.length = 0
+        self.lo = None
+        self.sfd = False
+        self.pending = bytearray()
+        self.data = bytearray()
+
+    def push(self, nibble):
+        if self.lo is None:
+            self.lo = nibble
+            return
 
-FCS_GOOD = zlib.crc32(b'\0\0\0\0')
+        byte = nibble << 4 | self.lo
+        self.lo = None
+        if not self.sfd:
+            self.sfd = byte == SFD
+            return
 
-async def check_fcs(packet):
-    packet = await alist(packet)
-    fcs = zlib.crc32(bytes(packet))
-    if fcs != FCS_GOOD:
-        raise FrameCheckError
-    elif len(packet) < 64:
-        raise PaddingError
-    return packet[:-4]
-
-def recv_packet(mac):
-    return check_fcs(skip_preamble(nibbles_to_bytes(mii_recv_packet(mac, {
-        'ce': mac.mii_tx_ce,
-        'data': mac.mii_txd,
-        'valid': mac.mii_tx_en,
-    }))))
+        self.pending.append(byte)
+        if len(self.pending) >= self.BLOCK:
+            self.fold()
+
+    def fold(self):
+        self.crc = zlib.crc32(self.pending, self.crc)
+        self.length += len(self.pending)
+        if self.keep:
+            self.data += self.pending
+        self.pending.clear()
+
+    # Finish the current frame, returning its data (without the FCS) if we
+    # are keeping it, and its length otherwise
+    def end(self):
+        self.fold()
+        self.frames += 1
+        try:
+            if self.lo is not None:
+                self.alignment_errors += 1
+                raise AlignmentError
+            elif self.crc != FCS_GOOD:
+                self.fcs_errors += 1
+                raise FrameCheckError
+            elif self.length < 64:
+                self.padding_errors += 1
+                raise PaddingError
+
+            if self.keep:
+                return list(self.data[:-4])
+            return self.length - 4
+        finally:
+            self.reset()
+
+async def recv_packet(mac, checker=None):
+    if checker is None:
+        checker = FCSChecker()
+
+    bus = MIIBus(mac, 'mii_tx_', data='mii_txd', valid='mii_tx_en')
+    async for nibble in mii_recv_packet(mac, bus):
+        checker.push(int(nibble))
+    return checker.end()
 
 async def expect_bad_fcs(mac):
     try:
@@ -110,33 +142,50 @@ async def expect_bad_fcs(mac):
         raise AssertionError
 
 class Status(enum.Enum):
-    OK = enum.auto()
-    GAVE_UP = enum.auto()
-    LATE_COLLISION = enum.auto()
-    UNDERFLOW = enum.auto()
+    OK = 'transmit_ok'
+    GAVE_UP = 'gave_up'
+    LATE_COLLISION = 'late_collision'
+    UNDERFLOW = 'underflow'
+
+# Record the status strobes as they happen. Each strobe has its own watcher
+# which only wakes up when it rises, so strobes which rise together are all
+# recorded, and each rising edge is recorded exactly once. tally holds the
+# number of times we've seen each status, and timeline holds (time in ns,
+# status) for each strobe.
+class StatusMonitor:
+    def __init__(self, mac):
+        self.strobes = {status: getattr(mac, status.value) for status in Status}
+        self.tally = collections.Counter()
+        self.timeline = []
+        self.updated = Event()
+        self.tasks = [cocotb.start_soon(self.watch(status, strobe))
+                      for status, strobe in self.strobes.items()]
+
+    async def watch(self, status, strobe):
+        edge = RisingEdge(strobe)
+        while True:
+            await edge
+            self.tally[status] += 1
+            self.timeline.append((get_sim_time('ns'), status))
+            updated = self.updated
+            self.updated = Event()
+            updated.set()
+
+# The StatusMonitor for each MAC, created by init
+monitors = {}
 
 async def get_status(mac):
-    ok = 0
-    gave_up = 0
-    late = 0
-    underflow = 0
-
-    while not (ok or gave_up or late or underflow) or mac.mii_tx_en.value:
-        await RisingEdge(mac.clk)
-        ok += mac.transmit_ok.value
-        gave_up += mac.gave_up.value
-        late += mac.late_collision.value
-        underflow += mac.underflow.value
-
-    assert ok + gave_up + late + underflow == 1
-    if ok:
-        return Status.OK
-    elif gave_up:
-        return Status.GAVE_UP
-    elif late:
-        return Status.LATE_COLLISION
-    elif underflow:
-        return Status.UNDERFLOW
+    monitor = monitors[mac]
+    start = len(monitor.timeline)
+    while len(monitor.timeline) == start:
+        await monitor.updated.wait()
+
+    if mac.mii_tx_en.value:
+        await FallingEdge(mac.mii_tx_en)
+
+    statuses = monitor.timeline[start:]
+    assert len(statuses) == 1
+    return statuses[0][1]
 
 async def start(mac, packet, **kwargs):
     send = await cocotb.start(send_packet(mac, packet, **kwargs))
@@ -182,7 +231,7 @@ async def ok(mac, packet, status, ns=None):
 
 @timeout(50, 'us')
 async def test_send(mac, ratio):
-    await init(mac)
+    monitor = await init(mac)
 
     packets = (
         list(range(32)),
@@ -209,6 +258,7 @@ async def test_send(mac, ratio):
 
         compare(await recv.join(), packet)
         assert await status.join() == Status.OK
+    assert monitor.tally == {Status.OK: len(packets)}
 
 send_tests = TestFactory(test_send)
 send_tests.add_option('ratio', (1, BIT_TIME_NS))
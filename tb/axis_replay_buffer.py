@@ -1,54 +1,231 @@
 # SPDX-License-Identifier: AGPL-3.0-Only
 # Copyright (C) 2022 Sean Anderson <seanga2@gmail.com>
 
+import collections
+import random
+
 import cocotb
 from cocotb.binary import BinaryValue
 from cocotb.clock import Clock
+from cocotb.queue import Queue
 from cocotb.regression import TestFactory
-from cocotb.triggers import ClockCycles, FallingEdge, RisingEdge, Timer
+from cocotb.triggers import ClockCycles, Event, FallingEdge, RisingEdge, Timer
+from cocotb.utils import get_sim_time
 
-from .util import ClockEnable, lookahead, timeout
+from .util import AXIS_PATTERNS, AXISBus, ClockEnable, always_high, detach_all, lookahead, timeout
 
 BUF_SIZE = 54
 
-async def send_packet(signals, packet, ratio=1, last_extra=0):
+async def send_packet(bus, packet, ratio=1, last_extra=0):
     for val, last in lookahead(packet):
         if last and last_extra:
-            await ClockCycles(signals['clk'], last_extra, rising=False)
-        if 'err' in signals:
+            await ClockCycles(bus.clk, last_extra, rising=False)
+        if bus.err is not None:
             if val is None:
-                signals['data'].value = 0
-                signals['err'].value = 1
+                bus.data.value = 0
+                bus.err.value = 1
             else:
-                signals['data'].value = val
-                signals['err'].value = 0
+                bus.data.value = val
+                bus.err.value = 0
         else:
-            signals['data'].value = val
-        signals['valid'].value = 1
-        if 'last' in signals:
-            signals['last'].value = last
-        await RisingEdge(signals['clk'])
-        while not signals['ready'].value:
-            await RisingEdge(signals['clk'])
-        signals['valid'].value = 0
+            bus.data.value = val
+        bus.valid.value = 1
+        if bus.last is not None:
+            bus.last.value = last
+        await RisingEdge(bus.clk)
+        while not bus.ready.value:
+            await RisingEdge(bus.clk)
+        bus.valid.value = 0
         if ratio != 1 and not last:
-            await ClockCycles(signals['clk'], ratio - 1, rising=False)
+            await ClockCycles(bus.clk, ratio - 1, rising=False)
 
-async def recv_packet(signals, packet, last=None):
+async def recv_packet(bus, packet, last=None):
     if last is None:
         last = len(packet)
 
-    await RisingEdge(signals['clk'])
+    await RisingEdge(bus.clk)
     for i, val in enumerate(packet):
-        while not signals['valid'].value or not signals['ready'].value:
-            await RisingEdge(signals['clk'])
-        assert signals['data'].value == val
-        if 'last' in signals:
-            assert signals['last'].value == (i == last - 1)
-        await RisingEdge(signals['clk'])
+        while not bus.valid.value or not bus.ready.value:
+            await RisingEdge(bus.clk)
+        assert bus.data.value == val
+        if bus.last is not None:
+            assert bus.last.value == (i == last - 1)
+        await RisingEdge(bus.clk)
+
+# A frame queued on an AXISSource. done is set once its last beat is accepted.
+class AXISFrame:
+    def __init__(self, data):
+        self.data = data
+        self.queued = get_sim_time('ns')
+        self.done = Event()
+
+# Statistics common to AXISSource and AXISSink
+class AXISEndpoint:
+    def reset(self):
+        self.beats = 0
+        self.cycles = 0
+        self.stalls = 0
+        self.latencies = []
+
+    def utilization(self):
+        return self.beats / self.cycles if self.cycles else 0
+
+    def report(self, name):
+        print(f"{name}: {self.beats} beats in {self.cycles} cycles "
+              f"({self.utilization():.0%} utilization), {self.stalls} stalls")
+
+    def kill(self):
+        self.task.kill()
+
+# A queued AXI stream source. Frames are sent back-to-back in the order they
+# were submitted, driving on the falling edge of the clock. valids is a pattern
+# (see always_high) which gates valid each cycle. cycles counts the cycles
+# spent sending frames, stalls the cycles where valid was high but ready was
+# low, and latencies the time (in ns) from submitting each frame until it was
+# sent.
+class AXISSource(AXISEndpoint):
+    def __init__(self, bus, valids=always_high):
+        self.bus = bus
+        self.valids = valids()
+        self.frames = collections.deque()
+        self.wakeup = Event()
+        self.reset()
+        bus.valid.value = 0
+        self.task = cocotb.start_soon(self.run())
+
+    def submit(self, data):
+        frame = AXISFrame(data)
+        self.frames.append(frame)
+        self.wakeup.set()
+        return frame
+
+    async def send(self, data):
+        await self.submit(data).done.wait()
+
+    def drive(self, val, last):
+        bus = self.bus
+        if bus.err is not None:
+            bus.err.value = val is None
+        bus.data.value = 0 if val is None else val
+        bus.valid.value = 1
+        if bus.last is not None:
+            bus.last.value = last
+
+    async def run(self):
+        bus = self.bus
+        falling = FallingEdge(bus.clk)
+        rising = RisingEdge(bus.clk)
+        while True:
+            while not self.frames:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+
+            while self.frames:
+                frame = self.frames[0]
+                for val, last in lookahead(frame.data):
+                    await falling
+                    while not next(self.valids):
+                        bus.valid.value = 0
+                        self.cycles += 1
+                        await falling
+
+                    self.drive(val, last)
+                    await rising
+                    self.cycles += 1
+                    while not bus.ready.value:
+                        self.stalls += 1
+                        await rising
+                        self.cycles += 1
+                    self.beats += 1
+
+                self.frames.popleft()
+                self.latencies.append(get_sim_time('ns') - frame.queued)
+                frame.done.set()
+
+            await falling
+            bus.valid.value = 0
+
+# An AXI stream sink. readies is a pattern which drives ready each cycle, or
+# None to just monitor a bus whose ready is driven by something else. Received
+# frames (with None for beats with err set) are queued for recv. Frames end on
+# last, or (for buses without last) once they are as long as the next expected
+# frame. Each frame is compared against the oldest expected one, and
+# mismatched holds (frame, expected) for each one which differed. cycles counts the cycles where a frame was in
+# flight, and stalls the cycles where valid was high but ready was low.
+# latencies holds the time (in ns) from expecting each frame until it arrived.
+class AXISSink(AXISEndpoint):
+    def __init__(self, bus, readies=always_high):
+        self.bus = bus
+        self.readies = None if readies is None else readies()
+        self.frames = Queue()
+        self.expected = collections.deque()
+        self.current = []
+        self.idle = Event()
+        self.idle.set()
+        self.mismatched = []
+        self.reset()
+        if self.readies is not None:
+            bus.ready.value = next(self.readies)
+        self.task = cocotb.start_soon(self.run())
+
+    def expect(self, data):
+        self.expected.append((list(data), get_sim_time('ns')))
+        self.idle.clear()
+
+    async def recv(self):
+        return await self.frames.get()
+
+    async def join(self):
+        await self.idle.wait()
+        assert not self.mismatched, \
+            f"{len(self.mismatched)} mismatched frame(s), first (got, expected): " \
+            f"{self.mismatched[0]}"
+
+    def finish(self):
+        frame, self.current = self.current, []
+        if self.expected:
+            expected, queued = self.expected.popleft()
+            self.latencies.append(get_sim_time('ns') - queued)
+            if frame != expected:
+                self.mismatched.append((frame, expected))
+            if not self.expected:
+                self.idle.set()
+        self.frames.put_nowait(frame)
+
+    async def run(self):
+        bus = self.bus
+        falling = FallingEdge(bus.clk)
+        rising = RisingEdge(bus.clk)
+        while True:
+            if not (self.current or bus.valid.value):
+                await RisingEdge(bus.valid)
+            if self.readies is not None:
+                await falling
+                bus.ready.value = next(self.readies)
+            await rising
+            self.cycles += 1
+
+            if not bus.valid.value:
+                continue
+            if not bus.ready.value:
+                self.stalls += 1
+                continue
+            self.beats += 1
+
+            if bus.err is not None and bus.err.value:
+                self.current.append(None)
+            else:
+                self.current.append(int(bus.data.value))
+
+            if bus.last is None:
+                if self.expected and len(self.current) == len(self.expected[0][0]):
+                    self.finish()
+            elif bus.last.value:
+                self.finish()
 
 @timeout(30, 'us')
 async def test_replay(buf, in_ratio, out_ratio):
+    await detach_all()
     buf.clk.value = BinaryValue('Z')
     buf.rst.value = 1
     buf.s_axis_valid.value = 0
@@ -60,7 +237,7 @@ async def test_replay(buf, in_ratio, out_ratio):
     async def init():
         await Timer(1)
         await cocotb.start(Clock(buf.clk, 8, units='ns').start())
-        await cocotb.start(ClockEnable(buf.clk, buf.m_axis_ready, out_ratio))
+        ClockEnable(buf.clk, buf.m_axis_ready, out_ratio)
         await FallingEdge(buf.clk)
         buf.rst.value = 0
     await cocotb.start(init())
@@ -71,25 +248,16 @@ async def test_replay(buf, in_ratio, out_ratio):
     # reusing anything from the last test.
     packets = [list(range(54)), list(range(64, 128)), list(range(128, 512))]
 
+    s_axis = AXISBus(buf, 's_axis_')
+    m_axis = AXISBus(buf, 'm_axis_')
+
     async def send():
         for packet in packets:
-            await send_packet({
-                'clk': buf.clk,
-                'data': buf.s_axis_data,
-                'valid': buf.s_axis_valid,
-                'last': buf.s_axis_last,
-                'ready': buf.s_axis_ready,
-            }, packet, in_ratio)
+            await send_packet(s_axis, packet, in_ratio)
 
     async def recv(packet):
         async def recv_len(length):
-            await recv_packet({
-                'clk': buf.clk,
-                'ready': buf.m_axis_ready,
-                'valid': buf.m_axis_valid,
-                'last': buf.m_axis_last,
-                'data': buf.m_axis_data,
-            }, packet[:length], last=len(packet))
+            await recv_packet(m_axis, packet[:length], last=len(packet))
 
         async def restart():
             await FallingEdge(buf.clk)
@@ -120,3 +288,42 @@ replay_tests = TestFactory(test_replay)
 replay_tests.add_option('in_ratio', (1, 4))
 replay_tests.add_option('out_ratio', (1, 4))
 replay_tests.generate_tests()
+
+@timeout(100, 'us')
+async def test_stream(buf, valids, readies):
+    await detach_all()
+    buf.clk.value = BinaryValue('Z')
+    buf.rst.value = 1
+    buf.s_axis_valid.value = 0
+    buf.s_axis_last.value = 0
+    buf.m_axis_ready.value = 0
+    buf.replay.value = 0
+    # Never replay, so the buffer is just a FIFO
+    buf.done.value = 1
+
+    await Timer(1)
+    await cocotb.start(Clock(buf.clk, 8, units='ns').start())
+    await FallingEdge(buf.clk)
+    buf.rst.value = 0
+
+    source = AXISSource(AXISBus(buf, 's_axis_'), valids)
+    sink = AXISSink(AXISBus(buf, 'm_axis_'), readies)
+
+    for _ in range(16):
+        packet = [random.randrange(256) for _ in range(random.randrange(1, 2 * BUF_SIZE))]
+        source.submit(packet)
+        sink.expect(packet)
+    await sink.join()
+
+    source.report('s_axis')
+    sink.report('m_axis')
+    print(f"latency: {max(sink.latencies)} ns max")
+    assert sink.beats == source.beats
+    # Make sure readies actually reached m_axis_ready
+    if readies is not always_high:
+        assert sink.stalls
+
+stream_tests = TestFactory(test_stream)
+stream_tests.add_option('valids', AXIS_PATTERNS)
+stream_tests.add_option('readies', AXIS_PATTERNS)
+stream_tests.generate_tests()
@@ -1,15 +1,18 @@
 # SPDX-License-Identifier: AGPL-3.0-Only
 # Copyright (C) 2023 Sean Anderson <seanga2@gmail.com>
 
+import itertools
+import random
+
 import cocotb
 from cocotb.binary import BinaryValue
 from cocotb.clock import Clock
 from cocotb.regression import TestFactory
 from cocotb.triggers import FallingEdge, Timer
 
-from .axis_replay_buffer import send_packet, recv_packet
-from .mdio import wb_read, wb_write, wb_err
-from .util import BIT, ClockEnable, GENMASK, timeout
+from .axis_replay_buffer import AXISSink, AXISSource, send_packet, recv_packet
+from .mdio import WishboneSlave, random_xfers, wb_read, wb_write, wb_err
+from .util import AXISBus, BIT, ClockEnable, GENMASK, WishboneBus, detach_all, rand_high, timeout
 
 CMD_CLEAR = BIT(0)
 CMD_WE = BIT(1)
@@ -69,8 +72,8 @@ class Encoder:
         self.last_addr = (addr & ~GENMASK(7, 0)) | ((addr + postinc) & GENMASK(7, 0))
         return (cmd, *addr_bytes, *data_bytes)
 
-@timeout(10, 'us')
-async def test_bridge(bridge, in_ratio, out_ratio):
+async def setup(bridge):
+    await detach_all()
     bridge.clk.value = BinaryValue('Z')
     bridge.rst.value = 1
     bridge.s_axis_valid.value = 0
@@ -83,33 +86,15 @@ async def test_bridge(bridge, in_ratio, out_ratio):
     bridge.rst.value = 0
     await cocotb.start(Clock(bridge.clk, 8, units='ns').start())
     await FallingEdge(bridge.clk)
-    await cocotb.start(ClockEnable(bridge.clk, bridge.m_axis_ready, out_ratio))
-
-    s_axis = {
-        'clk': bridge.clk,
-        'ready': bridge.s_axis_ready,
-        'valid': bridge.s_axis_valid,
-        'data': bridge.s_axis_data,
-    }
-
-    m_axis = {
-        'clk': bridge.clk,
-        'ready': bridge.m_axis_ready,
-        'valid': bridge.m_axis_valid,
-        'data': bridge.m_axis_data,
-    }
-
-    wb = {
-        'clk': bridge.clk,
-        'ack': bridge.wb_ack,
-        'err': bridge.wb_err,
-        'cyc': bridge.wb_cyc,
-        'stb': bridge.wb_stb,
-        'we': bridge.wb_we,
-        'addr': bridge.wb_addr,
-        'data_write': bridge.wb_data_write,
-        'data_read': bridge.wb_data_read,
-    }
+
+@timeout(10, 'us')
+async def test_bridge(bridge, in_ratio, out_ratio):
+    await setup(bridge)
+    ClockEnable(bridge.clk, bridge.m_axis_ready, out_ratio)
+
+    s_axis = AXISBus(bridge, 's_axis_')
+    m_axis = AXISBus(bridge, 'm_axis_')
+    wb = WishboneBus(bridge, 'wb_')
 
     e = Encoder()
 
@@ -171,3 +156,38 @@ bridge_tests = TestFactory(test_bridge)
 bridge_tests.add_option('in_ratio', (1, 4))
 bridge_tests.add_option('out_ratio', (1, 4))
 bridge_tests.generate_tests()
+
+# The command (and expected response) for each of xfers
+def random_commands(xfers):
+    e = Encoder()
+    for addr, data, result, err in xfers:
+        postinc = random.randrange(2)
+        if data is None:
+            resp = (STATUS_ERR,) if err else (0, *result.to_bytes(2, 'big'))
+        else:
+            resp = (STATUS_WE | (STATUS_ERR if err else 0),)
+        yield e.encode(addr, data, postinc), resp
+
+@cocotb.test(timeout_time=500, timeout_unit='us')
+async def test_random(bridge):
+    await setup(bridge)
+
+    source = AXISSource(AXISBus(bridge, 's_axis_'), rand_high)
+    sink = AXISSink(AXISBus(bridge, 'm_axis_'), rand_high)
+    slave = WishboneSlave(WishboneBus(bridge, 'wb_'), wait_states=lambda: random.randrange(3),
+                          errors=(range(0xffff0000, 0x100000000),))
+
+    # Mix addresses which are close together (short to encode) and far apart
+    addrs = [0x01234500 | random.randrange(0x100) for _ in range(16)]
+    addrs += [random.randrange(0xffff0000) for _ in range(15)] + [0xffffffff]
+    xfers = list(random_xfers(slave, addrs, 1000))
+    cmds, resps = zip(*random_commands(xfers))
+
+    # m_axis has no last, so expect all the responses as one frame
+    sink.expect(itertools.chain(*resps))
+    source.submit(tuple(itertools.chain(*cmds)))
+    await sink.join()
+    source.report('s_axis')
+    sink.report('m_axis')
+    assert sink.stalls
+    assert slave.log == [(addr, data, err) for addr, data, _, err in xfers]
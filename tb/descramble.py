@@ -10,16 +10,43 @@ from cocotb.regression import TestFactory
 from cocotb.result import SimTimeoutError
 from cocotb.triggers import ClockCycles, FallingEdge, RisingEdge, Timer, with_timeout
 
-from .util import compare_lists, send_recovered_bits, timeout, with_valids
+from scripts.lfsr import sequence, step_state
+from .util import GENMASK, align, compare_lists, send_recovered_bits, timeout, unpack_bits, with_valids
 
-def scramble(bits):
-    lfsr = random.randrange(1, 0x7ff)
-    for bit in bits:
-        ldd = (lfsr >> 10) ^ ((lfsr >> 8) & 1)
-        yield bit ^ ldd
-        lfsr <<= 1
-        lfsr &= 0x7ff
-        lfsr |= ldd
+# x^11 + x^9 + 1
+TAPS = (10, 8)
+LFSR_WIDTH = TAPS[0] + 1
+LFSR_MASK = GENMASK(LFSR_WIDTH - 1, 0)
+
+def bitrev(value, width):
+    return int(format(value, f"0{width}b")[::-1], 2)
+
+class Keystream:
+    def __init__(self, state=None):
+        self.state = random.randrange(1, LFSR_MASK) if state is None else state
+
+    def seek(self, steps):
+        self.state = step_state(TAPS, self.state, steps)
+
+    def read(self, length):
+        bits = sequence(TAPS, self.state, length)
+        self.seek(length)
+        return bits
+
+    def scramble(self, value, length):
+        return value ^ self.read(length)
+
+def scramble(bits, block=256):
+    bits = iter(bits)
+    keystream = Keystream()
+    while True:
+        count = 0
+        # Take the key first so we don't drop a bit when it runs out
+        for key, bit in zip(unpack_bits(keystream.read(block), block), bits):
+            yield bit ^ key
+            count += 1
+        if count < block:
+            return
 
 async def send_scrambled(descrambler, data, valids):
     descrambler.signal_status.value = 1
@@ -78,14 +105,7 @@ async def test_descramble(descrambler, valids):
             outs.append(descrambler.descrambled[1].value)
             outs.append(descrambler.descrambled[0].value)
 
-    best_corr = -1
-    best_off = None
-    for off in range(28, 42):
-        corr = sum(i == o for i, o in zip(ins[off:], outs))
-        if corr > best_corr:
-            best_corr = corr
-            best_off = off
-
+    best_off, best_corr = align(ins, outs, range(28, 42))
     print(f"best offset is {best_off} correlation {best_corr/(len(ins) - best_off)}")
     compare_lists(ins[best_off:], outs)
 
@@ -9,14 +9,10 @@ from cocotb.clock import Clock
 from cocotb.triggers import ClockCycles, Combine, FallingEdge, Join, RisingEdge, Timer
 from cocotb.types import LogicArray
 
-from .descramble import scramble
-from .mdio_regs import BMSR, BMSR_LSTATUS, VCR, VCR_LTEST, wb_xfer
-from .nrzi_encode import nrzi_encode
-from .nrzi_decode import nrzi_decode
-from .pcs_tx import as_nibbles, mii_send_packet, pcs_recv_packet
-from .pcs_rx import frame, mii_recv_packet
-from .scramble import descramble
-from .util import BIT, alist
+from .mdio_regs import BMSR, BMSR_LSTATUS, REGS, VCR, VCR_LTEST, WishboneMaster, wb_xfer
+from .pcs_tx import LineDecoder, as_nibbles, mii_send_packet
+from .pcs_rx import LineEncoder, mii_recv_packet
+from .util import BIT, WishboneBus, alist, recv_frames, unpack_bits
 
 @cocotb.test(timeout_time=5, timeout_unit='us')
 async def test_hub(hub):
@@ -29,63 +25,44 @@ async def test_hub(hub):
     await cocotb.start(Clock(hub.clk_125, 8, units='ns').start())
     await cocotb.start(Clock(hub.clk_250, 4, units='ns').start())
 
-    wb = {
-        'clk': hub.clk_125,
-        'cyc': hub.wb_cyc,
-        'stb': hub.wb_stb,
-        'we': hub.wb_we,
-        'addr': hub.wb_addr,
-        'data_write': hub.wb_data_write,
-        'data_read': hub.wb_data_read,
-        'ack': hub.wb_ack,
-        'err': hub.wb_err,
-    }
+    wb = WishboneBus(hub, 'wb_', clk='clk_125')
 
     # Enable fast link stabilization for testing
     for i in range(4):
         await wb_xfer(wb, BIT(i + 5) + VCR, VCR_LTEST, delay=2)
 
     packet = list(as_nibbles((0x55, *b"Hello world!")))
-    packet_bits = list(itertools.chain.from_iterable(frame(packet)))
-    itertools.chain(itertools.repeat(1, 120), packet_bits, itertools.repeat(1))
 
-    async def send_rx(i, bits):
+    async def send_rx(i, items):
         hub.signal_detect[i].value = 1
-        for bit in nrzi_encode(scramble(bits)):
-            hub.indicate_data[i].value = bit
-            await Timer(8, units='ns')
+        for chunk in LineEncoder().encode(items):
+            for bit in unpack_bits(*chunk):
+                hub.indicate_data[i].value = bit
+                await Timer(8, units='ns')
         hub.signal_detect[i].value = 0
         hub.indicate_data[i].value = BinaryValue('X')
 
     async def recv_tx(i, packets):
-        async def bits():
-            await ClockCycles(hub.clk_125, 1)
-            while True:
-                await RisingEdge(hub.clk_125)
-                yield hub.request_data[i].value
+        await ClockCycles(hub.clk_125, 1)
+        frames = recv_frames(hub.clk_125, hub.request_data[i], LineDecoder())
 
-        data = descramble(nrzi_decode(bits()))
         for expected, valid in packets:
-            actual = await alist(pcs_recv_packet(None, data))
+            actual = await anext(frames)
             if valid:
                 assert actual == expected
             else:
                 assert actual != expected
 
     await cocotb.start(send_rx(0, itertools.chain(
-        itertools.repeat(1, 120),
-        packet_bits,
-        itertools.repeat(1, 120),
-        packet_bits,
-        itertools.repeat(1),
+        (120, packet, 120, packet),
+        itertools.repeat(120),
     )))
     await cocotb.start(send_rx(1, itertools.chain(
-        itertools.repeat(1, 300),
-        packet_bits,
-        itertools.repeat(1),
+        (300, packet),
+        itertools.repeat(120),
     )))
-    await cocotb.start(send_rx(2, itertools.repeat(1)))
-    await cocotb.start(send_rx(3, itertools.repeat(1)))
+    await cocotb.start(send_rx(2, itertools.repeat(120)))
+    await cocotb.start(send_rx(3, itertools.repeat(120)))
 
     receivers = [
             await cocotb.start(recv_tx(0, ((packet, False),))),
@@ -99,3 +76,36 @@ async def test_hub(hub):
     for i in range(4):
         assert not await wb_xfer(wb, BIT(i + 5) + BMSR, delay=2) & BMSR_LSTATUS
         assert await wb_xfer(wb, BIT(i + 5) + BMSR, delay=2) & BMSR_LSTATUS
+
+@cocotb.test(timeout_time=50, timeout_unit='us')
+async def test_sweep(hub):
+    hub.clk_125.value = BinaryValue('Z')
+    hub.clk_250.value = BinaryValue('Z')
+    hub.signal_detect.value = 0
+    hub.wb_cyc.value = 1
+
+    await Timer(1)
+    await cocotb.start(Clock(hub.clk_125, 8, units='ns').start())
+    await cocotb.start(Clock(hub.clk_250, 4, units='ns').start())
+
+    master = WishboneMaster(WishboneBus(hub, 'wb_', clk='clk_125'))
+    ports = len(hub.signal_detect)
+
+    # Read every register through every combination of port bits
+    txns = [master.submit(addr) for addr in range(BIT(ports + 5))]
+    await txns[-1].done.wait()
+
+    for addr, txn in enumerate(txns):
+        # Every port has the same registers, so it doesn't matter which one
+        # gets selected. The PHYs emulate pull-ups, so unimplemented
+        # registers read as all ones instead of returning an error.
+        if addr >> 5:
+            assert not txn.err
+            if addr & 0x1f not in REGS:
+                assert txn.result == 0xffff
+        else:
+            assert txn.err
+
+    # Errors come from the hub itself, and everything else has to go through a
+    # port, which takes a couple more cycles
+    assert master.latencies == {1: BIT(5), 3: len(txns) - BIT(5)}
@@ -1,14 +1,16 @@
 # SPDX-License-Identifier: AGPL-3.0-Only
 # Copyright (C) 2022 Sean Anderson <seanga2@gmail.com>
 
+import itertools
 import random
 
 import cocotb
 from cocotb.clock import Clock
-from cocotb.triggers import ClockCycles, Edge, FallingEdge, First, RisingEdge, Timer
+from cocotb.queue import Queue
+from cocotb.triggers import ClockCycles, Edge, Event, FallingEdge, First, RisingEdge, Timer
 from cocotb.types import LogicArray
 
-from .util import ClockEnable
+from .util import ClockEnable, WishboneBus, detach_all, logic_value
 
 def to_bits(val, width):
     for bit in range(width - 1, -1, -1):
@@ -32,18 +34,41 @@ def frame(phyad, regad, data=None, *, st=0b01, op=None, preamble_bits=32):
     yield 0
     yield from to_bits(data, 16)
 
-# Should be 50, but reduced to simulate faster
-MDIO_RATIO = 3
-
-async def mdio_read(mdio, phyad, regad, **kwargs):
-    ret = 0
-
-    for bit in frame(phyad, regad, **kwargs):
+# The real ratio of clk to MDC
+MDIO_RATIO = 50
+# A reduced ratio to simulate faster
+FAST_RATIO = 3
+
+# Runs of identical bits, as (bit, length)
+def runs(bits):
+    return [(bit, len(tuple(run))) for bit, run in itertools.groupby(bits)]
+
+# Drive runs on mdi, holding it steady for each run. We start on the next rising
+# edge of ce, and finish after the falling edge of ce for the last bit. This
+# only wakes up once per run, but never drives X between bits like send_bits.
+async def send_runs(mdio, runs):
+    await RisingEdge(mdio.ce)
+    for i, (bit, length) in enumerate(runs):
+        mdio.mdi.value = bit
+        if i < len(runs) - 1:
+            await ClockCycles(mdio.ce, length)
+        else:
+            if length > 1:
+                await ClockCycles(mdio.ce, length - 1)
+            await FallingEdge(mdio.ce)
+    mdio.mdi.value = logic_value('X')
+
+# Drive each bit on mdi while ce is high, and X the rest of the time. This
+# catches sampling mdi on the wrong edge of ce.
+async def send_bits(mdio, bits):
+    for bit in bits:
         await RisingEdge(mdio.ce)
         mdio.mdi.value = bit
         await FallingEdge(mdio.ce)
-        mdio.mdi.value = LogicArray('X')
+        mdio.mdi.value = logic_value('X')
 
+async def recv_data(mdio):
+    ret = 0
     for bit in range(19):
         await RisingEdge(mdio.ce)
         await RisingEdge(mdio.clk)
@@ -67,79 +92,214 @@ async def mdio_read(mdio, phyad, regad, **kwargs):
 
     return ret
 
-async def mdio_write(mdio, phyad, regad, data, **kwargs):
-    for bit in frame(phyad, regad, data, **kwargs):
-        await RisingEdge(mdio.ce)
-        mdio.mdi.value = bit
-        await FallingEdge(mdio.ce)
-        mdio.mdi.value = LogicArray('X')
-
-async def wb_read(signals, addr, data):
-    while not (signals['cyc'].value and signals['stb'].value):
-        await FallingEdge(signals['clk'])
-
-    assert not signals['we'].value
-    assert signals['addr'].value == addr
-    signals['data_read'].value = data
-    signals['ack'].value = 1
-
-    await RisingEdge(signals['clk'])
-    signals['ack'].value = 0
-    signals['data_read'].value = LogicArray('X' * 16)
-
-    await FallingEdge(signals['clk'])
-    assert not signals['stb'].value
-
-async def wb_write(signals, addr, data):
-    while not (signals['cyc'].value and signals['stb'].value):
-        await FallingEdge(signals['clk'])
-
-    signals['ack'].value = 1
-
-    await RisingEdge(signals['clk'])
-    assert signals['we'].value
-    assert signals['addr'].value == addr
-    assert signals['data_write'].value == data
-    signals['ack'].value = 0
-
-    await FallingEdge(signals['clk'])
-    assert not signals['stb'].value
-
-async def wb_err(signals):
-    while not (signals['cyc'].value and signals['stb'].value):
-        await FallingEdge(signals['clk'])
+async def mdio_read(mdio, phyad, regad, **kwargs):
+    await send_bits(mdio, frame(phyad, regad, **kwargs))
+    return await recv_data(mdio)
 
-    signals['err'].value = 1
-    await RisingEdge(signals['clk'])
-    signals['err'].value = 0
-    await FallingEdge(signals['clk'])
-    assert not signals['stb'].value
+async def mdio_write(mdio, phyad, regad, data, **kwargs):
+    await send_bits(mdio, frame(phyad, regad, data, **kwargs))
+
+# A read or write queued on an MDIOMaster. The frame is converted to runs of
+# bits when the transaction is created. Once done is set, result holds the
+# data read (or None if there was no response).
+class MDIOTransaction:
+    def __init__(self, phyad, regad, data=None, preamble_bits=32, **kwargs):
+        self.write = data is not None
+        self.preamble_bits = preamble_bits
+        self.runs = runs(frame(phyad, regad, data, preamble_bits=0, **kwargs))
+        self.result = None
+        self.done = Event()
+
+# A queued MDIO master. Transactions are driven back-to-back in the order they
+# were submitted. With fast set, ce (a ClockEnable) runs at FAST_RATIO during
+# the preamble, and at ratio for the rest of the frame. This keeps the preamble
+# from dominating the simulation time, while the protocol timing after it is
+# the same as a real MDC.
+class MDIOMaster:
+    def __init__(self, mdio, ce=None, ratio=MDIO_RATIO, fast=False):
+        self.mdio = mdio
+        self.ce = ce
+        self.ratio = ratio
+        self.fast = fast
+        self.queue = Queue()
+        self.task = cocotb.start_soon(self.run())
+
+    def submit(self, phyad, regad, data=None, **kwargs):
+        txn = MDIOTransaction(phyad, regad, data, **kwargs)
+        self.queue.put_nowait(txn)
+        return txn
+
+    async def read(self, phyad, regad, **kwargs):
+        txn = self.submit(phyad, regad, **kwargs)
+        await txn.done.wait()
+        return txn.result
+
+    async def write(self, phyad, regad, data, **kwargs):
+        await self.submit(phyad, regad, data, **kwargs).done.wait()
+
+    async def run(self):
+        mdio = self.mdio
+        while True:
+            txn = await self.queue.get()
+            if txn.preamble_bits:
+                await RisingEdge(mdio.ce)
+                if self.fast:
+                    self.ce.start(FAST_RATIO)
+                mdio.mdi.value = 1
+                await ClockCycles(mdio.ce, txn.preamble_bits - 1)
+                # Slow down while ce is high for the last bit, so the next
+                # bit comes a full MDC period later
+                if self.fast:
+                    self.ce.start(self.ratio)
+                await FallingEdge(mdio.ce)
+
+            await send_runs(mdio, txn.runs)
+            if not txn.write:
+                txn.result = await recv_data(mdio)
+            txn.done.set()
+
+    def kill(self):
+        self.task.kill()
+
+async def wb_read(bus, addr, data):
+    while not (bus.cyc.value and bus.stb.value):
+        await FallingEdge(bus.clk)
+
+    assert not bus.we.value
+    assert bus.addr.value == addr
+    bus.data_read.value = data
+    bus.ack.value = 1
+
+    await RisingEdge(bus.clk)
+    bus.ack.value = 0
+    bus.data_read.value = logic_value('X', 16)
+
+    await FallingEdge(bus.clk)
+    assert not bus.stb.value
+
+async def wb_write(bus, addr, data):
+    while not (bus.cyc.value and bus.stb.value):
+        await FallingEdge(bus.clk)
+
+    bus.ack.value = 1
+
+    await RisingEdge(bus.clk)
+    assert bus.we.value
+    assert bus.addr.value == addr
+    assert bus.data_write.value == data
+    bus.ack.value = 0
+
+    await FallingEdge(bus.clk)
+    assert not bus.stb.value
+
+async def wb_err(bus):
+    while not (bus.cyc.value and bus.stb.value):
+        await FallingEdge(bus.clk)
+
+    bus.err.value = 1
+    await RisingEdge(bus.clk)
+    bus.err.value = 0
+    await FallingEdge(bus.clk)
+    assert not bus.stb.value
+
+# A Wishbone slave backed by a sparse register file. Like wb_read and friends,
+# requests are sampled on the falling edge of the clock. Each request is
+# answered after wait_states cycles (either a number, or a function returning
+# one). Accesses to addresses in any of errors (e.g. ranges) get err instead of
+# ack, and don't touch regs. Reads of addresses which were never written return
+# default. Each access is recorded in log as (addr, data, err), where data is
+# None for reads.
+class WishboneSlave:
+    def __init__(self, bus, regs=None, wait_states=0, errors=(), default=0):
+        self.bus = bus
+        self.regs = {} if regs is None else regs
+        self.wait_states = wait_states
+        self.errors = errors
+        self.default = default
+        self.log = []
+        bus.ack.value = 0
+        bus.err.value = 0
+        self.task = cocotb.start_soon(self.run())
+
+    def error(self, addr):
+        return any(addr in region for region in self.errors)
+
+    async def run(self):
+        bus = self.bus
+        while True:
+            await FallingEdge(bus.clk)
+            if not bus.stb.value:
+                await RisingEdge(bus.stb)
+                continue
+            if bus.cyc is not None and not bus.cyc.value:
+                continue
+
+            wait_states = self.wait_states
+            if callable(wait_states):
+                wait_states = wait_states()
+            if wait_states:
+                await ClockCycles(bus.clk, wait_states, rising=False)
+
+            addr = int(bus.addr.value)
+            err = self.error(addr)
+            if bus.we.value:
+                data = int(bus.data_write.value)
+                if not err:
+                    self.regs[addr] = data
+            else:
+                data = None
+                if not err:
+                    bus.data_read.value = self.regs.get(addr, self.default)
+            self.log.append((addr, data, err))
+
+            if err:
+                bus.err.value = 1
+            else:
+                bus.ack.value = 1
+            await RisingEdge(bus.clk)
+            bus.ack.value = 0
+            bus.err.value = 0
+            bus.data_read.value = logic_value('X', len(bus.data_read))
+
+    def kill(self):
+        self.task.kill()
+
+# Generate count random reads and writes of addrs for slave, as (addr, data,
+# result, err). data is None for reads, and result is what a read should
+# return (or None for writes and errors). Accesses are assumed to happen in
+# order, so slave.log should end up matching (addr, data, err) for each one.
+def random_xfers(slave, addrs, count):
+    regs = dict(slave.regs)
+    width = len(slave.bus.data_write)
+    for _ in range(count):
+        addr = random.choice(addrs)
+        err = slave.error(addr)
+        result = None
+        if random.randrange(2):
+            data = random.randrange(1 << width)
+            if not err:
+                regs[addr] = data
+        else:
+            data = None
+            if not err:
+                result = regs.get(addr, slave.default)
+        yield addr, data, result, err
 
-async def setup(mdio):
+async def setup(mdio, ratio=FAST_RATIO):
+    await detach_all()
     mdio.mdi.value = 0
     mdio.ack.value = 0
     mdio.err.value = 0
-    mdio.data_read.value = LogicArray('X' * 16)
-    await cocotb.start(ClockEnable(mdio.clk, mdio.ce, MDIO_RATIO))
+    mdio.data_read.value = logic_value('X', 16)
+    ce = ClockEnable(mdio.clk, mdio.ce, ratio)
     await Timer(1)
     await cocotb.start(Clock(mdio.clk, 8, units='ns').start())
+    return ce
 
-def mdio_signals(mdio):
-    return {
-        'clk': mdio.clk,
-        'ack': mdio.ack,
-        'err': mdio.err,
-        'cyc': mdio.cyc,
-        'stb': mdio.stb,
-        'we': mdio.we,
-        'addr': mdio.addr,
-        'data_write': mdio.data_write,
-        'data_read': mdio.data_read,
-    }
-
-@cocotb.test(timeout_time=50, timeout_unit='us')
+@cocotb.test(timeout_time=600, timeout_unit='us')
 async def test_mdio(mdio):
-    await setup(mdio)
+    ce = await setup(mdio, MDIO_RATIO)
+    master = MDIOMaster(mdio, ce, fast=True)
 
     reads = [(i, random.randrange(0, 0xFFFF)) for i in range(16)]
     writes = [(i, random.randrange(0, 0xFFFF)) for i in range(16)]
@@ -148,14 +308,37 @@ async def test_mdio(mdio):
 
     async def rw_mdio():
         for (read, write) in zip(reads, writes):
-            assert await mdio_read(mdio, 0, read[0]) == read[1]
-            await mdio_write(mdio, 0, write[0], write[1])
+            assert await master.read(0, read[0]) == read[1]
+            await master.write(0, write[0], write[1])
     await cocotb.start(rw_mdio())
 
-    signals = mdio_signals(mdio)
+    bus = WishboneBus(mdio)
     for (read, write) in zip(reads, writes):
-        await wb_read(signals, read[0], read[1])
-        await wb_write(signals, write[0], write[1])
+        await wb_read(bus, read[0], read[1])
+        await wb_write(bus, write[0], write[1])
+
+@cocotb.test(timeout_time=2500, timeout_unit='us')
+async def test_scan(mdio):
+    ce = await setup(mdio, MDIO_RATIO)
+    master = MDIOMaster(mdio, ce, fast=True)
+    bus = WishboneBus(mdio)
+
+    regs = [random.randrange(0, 0xFFFF) for _ in range(4)]
+    txns = [(phyad, regad, master.submit(phyad, regad))
+            for phyad in range(32) for regad in range(len(regs))]
+
+    async def respond():
+        for regad, data in enumerate(regs):
+            await wb_read(bus, regad, data)
+    await cocotb.start(respond())
+
+    for phyad, regad, txn in txns:
+        await txn.done.wait()
+        # The default ADDRESS (the synthesized netlist has no parameters)
+        if phyad == 0:
+            assert txn.result == regs[regad]
+        else:
+            assert txn.result is None
 
 @cocotb.test(timeout_time=20, timeout_unit='us')
 async def test_badmdio(mdio):
@@ -184,14 +367,14 @@ async def test_badmdio(mdio):
 @cocotb.test(timeout_time=20, timeout_unit='us')
 async def test_badwb(mdio):
     await setup(mdio)
-    signals = mdio_signals(mdio)
+    bus = WishboneBus(mdio)
 
     async def bad_resp():
         # No ack
         await ClockCycles(mdio.stb, 2, False)
         # Error response
         for _ in range(2):
-            await wb_err(signals)
+            await wb_err(bus)
 
     await cocotb.start(bad_resp())
 
@@ -8,6 +8,8 @@ from cocotb.clock import Clock
 from cocotb.triggers import ClockCycles, Edge, FallingEdge, First, RisingEdge, Timer
 from cocotb.types import LogicArray
 
+from .util import logic_value
+
 @cocotb.test(timeout_time=50, timeout_unit='us')
 async def test_io(io):
     io.mdc.value = 0
@@ -26,7 +28,7 @@ async def test_io(io):
             await Timer(190, 'ns')
             io.mdio.value = bit
             await Timer(20, 'ns')
-            io.mdio.value = LogicArray('X')
+            io.mdio.value = logic_value('X')
             await FallingEdge(io.mdc)
     await cocotb.start(send_ins())
 
@@ -37,7 +39,7 @@ async def test_io(io):
         await FallingEdge(io.clk)
 
     outs = [random.randrange(2) for _ in range(10)]
-    io.mdio.value = LogicArray('Z')
+    io.mdio.value = logic_value('Z')
     await FallingEdge(io.clk)
     for bit in outs:
         io.mdo.value = bit
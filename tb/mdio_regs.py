@@ -1,12 +1,14 @@
 # SPDX-License-Identifier: AGPL-3.0-Only
 # Copyright (C) 2022 Sean Anderson <seanga2@gmail.com>
 
+import collections
+
 import cocotb
 from cocotb.clock import Clock
-from cocotb.triggers import FallingEdge, Timer
+from cocotb.triggers import Event, FallingEdge, Timer
 from cocotb.types import LogicArray
 
-from .util import BIT
+from .util import BIT, WishboneBus, logic_value
 
 BMCR = 0
 BMSR = 1
@@ -37,31 +39,138 @@ BMSR_EXTCAP = BIT(0)
 VCR_DTEST = BIT(15)
 VCR_LTEST = BIT(14)
 
-async def wb_xfer(signals, addr, data=None, delay=1):
-    await FallingEdge(signals['clk'])
-    signals['stb'].value = 1
-    signals['addr'].value = addr
+# Registers which don't respond with err
+REGS = {BMCR, BMSR, PHYID1, PHYID2, NWCR, PWCR, DCR, FCCR, SECR, VCR}
+
+async def wb_xfer(bus, addr, data=None, delay=1):
+    await FallingEdge(bus.clk)
+    bus.stb.value = 1
+    bus.addr.value = addr
     if data is None:
-        signals['we'].value = 0
+        bus.we.value = 0
     else:
-        signals['we'].value = 1
-        signals['data_write'].value = data
+        bus.we.value = 1
+        bus.data_write.value = data
 
     for _ in range(delay + 1):
-        await FallingEdge(signals['clk'])
-        if signals['ack'].value or signals['err'].value:
+        await FallingEdge(bus.clk)
+        if bus.ack.value or bus.err.value:
             break
 
-    assert signals['ack'].value or signals['err'].value
-    signals['stb'].value = 0
-    signals['we'].value = LogicArray('X')
-    signals['addr'].value = LogicArray('X' * len(signals['addr']))
-    signals['data_write'].value = LogicArray('X' * 16)
-    if data is None and signals['ack'].value:
-        return signals['data_read'].value
+    assert bus.ack.value or bus.err.value
+    bus.stb.value = 0
+    bus.we.value = logic_value('X')
+    bus.addr.value = logic_value('X', len(bus.addr))
+    bus.data_write.value = logic_value('X', 16)
+    if data is None and bus.ack.value:
+        return bus.data_read.value
 
-@cocotb.test(timeout_time=2, timeout_unit='us')
-async def test_mdio(regs):
+# A transaction queued on a WishboneMaster. Once done is set, err is set if the
+# slave responded with err, and result holds the data read (or None).
+class WishboneTransaction:
+    def __init__(self, addr, data=None):
+        self.addr = addr
+        self.data = data
+        self.issued = None
+        self.err = False
+        self.result = None
+        self.done = Event()
+
+# A queued Wishbone master. Like wb_xfer, signals are driven and sampled on the
+# falling edge of the clock. Transactions are issued in order. Like wb_xfer, stb
+# is dropped for a cycle after each response, since slaves which register ack
+# would otherwise ack the next request early. In pipelined mode, a new
+# request is issued every cycle without waiting for the last one to finish,
+# and responses are matched to requests in order. This only works for slaves
+# which never stall. latencies is a histogram of the number of cycles from
+# issuing each request to its response. Slaves must respond within timeout
+# cycles.
+class WishboneMaster:
+    def __init__(self, bus, pipelined=False, timeout=16):
+        self.bus = bus
+        self.pipelined = pipelined
+        self.timeout = timeout
+        self.requests = collections.deque()
+        self.latencies = collections.Counter()
+        self.wakeup = Event()
+        self.task = cocotb.start_soon(self.run())
+
+    def submit(self, addr, data=None):
+        txn = WishboneTransaction(addr, data)
+        self.requests.append(txn)
+        self.wakeup.set()
+        return txn
+
+    async def read(self, addr):
+        txn = self.submit(addr)
+        await txn.done.wait()
+        return txn.result
+
+    async def write(self, addr, data):
+        txn = self.submit(addr, data)
+        await txn.done.wait()
+        return not txn.err
+
+    def idle(self):
+        bus = self.bus
+        bus.stb.value = 0
+        bus.we.value = logic_value('X')
+        bus.addr.value = logic_value('X', len(bus.addr))
+        bus.data_write.value = logic_value('X', len(bus.data_write))
+
+    def issue(self, txn):
+        bus = self.bus
+        bus.stb.value = 1
+        bus.addr.value = txn.addr
+        if txn.data is None:
+            bus.we.value = 0
+            bus.data_write.value = logic_value('X', len(bus.data_write))
+        else:
+            bus.we.value = 1
+            bus.data_write.value = txn.data
+
+    async def run(self):
+        bus = self.bus
+        pending = collections.deque()
+        while True:
+            self.idle()
+            while not self.requests:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+
+            await FallingEdge(bus.clk)
+            cycle = 0
+            while self.requests or pending:
+                if self.requests and (self.pipelined or not pending):
+                    txn = self.requests.popleft()
+                    txn.issued = cycle
+                    pending.append(txn)
+                    self.issue(txn)
+                elif self.pipelined:
+                    self.idle()
+
+                await FallingEdge(bus.clk)
+                cycle += 1
+                if not (bus.ack.value or bus.err.value):
+                    assert cycle - pending[0].issued < self.timeout
+                    continue
+
+                txn = pending.popleft()
+                txn.err = bool(bus.err.value)
+                if txn.data is None and not txn.err:
+                    txn.result = int(bus.data_read.value)
+                self.latencies[cycle - txn.issued] += 1
+                txn.done.set()
+
+                if not self.pipelined:
+                    self.idle()
+                    await FallingEdge(bus.clk)
+                    cycle += 1
+
+    def kill(self):
+        self.task.kill()
+
+async def setup(regs):
     regs.cyc.value = 1
     regs.stb.value = 0
     regs.link_status.value = 1
@@ -72,17 +181,13 @@ async def test_mdio(regs):
     await Timer(1)
     await cocotb.start(Clock(regs.clk, 8, units='ns').start())
 
+@cocotb.test(timeout_time=2, timeout_unit='us')
+async def test_mdio(regs):
+    await setup(regs)
+    bus = WishboneBus(regs)
+
     def xfer(regad, data=None):
-        return wb_xfer({
-            'clk': regs.clk,
-            'stb': regs.stb,
-            'we': regs.we,
-            'addr': regs.addr,
-            'data_write': regs.data_write,
-            'data_read': regs.data_read,
-            'ack': regs.ack,
-            'err': regs.err,
-        }, regad, data)
+        return wb_xfer(bus, regad, data)
 
     async def reg_toggle(reg, bit, signal, ro_mask=0):
         if signal:
@@ -149,3 +254,19 @@ async def test_mdio(regs):
 
     await reg_toggle(VCR, VCR_DTEST, regs.descrambler_test)
     await reg_toggle(VCR, VCR_LTEST, regs.link_monitor_test)
+
+@cocotb.test(timeout_time=2, timeout_unit='us')
+async def test_sweep(regs):
+    await setup(regs)
+    master = WishboneMaster(WishboneBus(regs), pipelined=True)
+
+    txns = [master.submit(regad) for regad in range(32)]
+    await txns[-1].done.wait()
+
+    for regad, txn in enumerate(txns):
+        assert txn.err == (regad not in REGS)
+    assert txns[BMCR].result == (BMCR_SPEED_LSB | BMCR_ISOLATE)
+    assert txns[PHYID1].result == 0xd5ec
+    assert txns[PHYID2].result == 0x4800
+    # One request per cycle
+    assert master.latencies == {1: len(txns)}
@@ -1,18 +1,33 @@
 # SPDX-License-Identifier: AGPL-3.0-Only
 # Copyright (C) 2023 Sean Anderson <seanga2@gmail.com>
 
+import collections
+from fractions import Fraction
+import os
+import random
+
 import cocotb
 from cocotb.binary import BinaryValue
 from cocotb.clock import Clock
 from cocotb.regression import TestFactory
-from cocotb.triggers import ClockCycles, FallingEdge, RisingEdge, Timer
+from cocotb.triggers import ClockCycles, FallingEdge, ReadOnly, RisingEdge, Timer
 
-from .pcs_rx import mii_recv_packet
+from .pcs_rx import MIIMonitor, mii_recv_packet
+from .pcs import as_nibbles
 from .pcs_tx import mii_send_packet
-from .util import alist, ClockEnable, lookahead, timeout
+from .util import alist, ClockEnable, Metrics, MIIBus, StrobeCounter, detach_all, \
+    lookahead, timeout
+
+skip_slow = not os.environ.get('RUN_SLOW', False)
+
+# The default parameters in rtl/mii_elastic_buffer.v. The synthesized netlist
+# doesn't have them, so they can't be read from the DUT.
+BUF_SIZE = 5
+WATERMARK = (BUF_SIZE + 1) // 2
 
 @cocotb.test(timeout_time=50, timeout_unit='us')
 async def test_elastic(buf):
+    await detach_all()
     buf.clk.value = BinaryValue('Z')
     buf.tx_ce.value = 0
     buf.tx_en.value = 0
@@ -21,54 +36,35 @@ async def test_elastic(buf):
     await Timer(1)
     await cocotb.start(Clock(buf.clk, 8, units='ns').start())
     await FallingEdge(buf.clk)
-    await cocotb.start(ClockEnable(buf.clk, buf.tx_ce, 5))
+    ClockEnable(buf.clk, buf.tx_ce, 5)
     await FallingEdge(buf.clk)
-    rx_ce = await cocotb.start(ClockEnable(buf.clk, buf.rx_ce, 5))
+    rx_ce = ClockEnable(buf.clk, buf.rx_ce, 5)
 
-    underflows = 0
-    overflows = 0
+    underflows = StrobeCounter(buf.clk, buf.underflow)
+    overflows = StrobeCounter(buf.clk, buf.overflow)
 
-    async def count_excursions():
-        nonlocal underflows, overflows
-        while True:
-            await RisingEdge(buf.clk)
-            underflows += buf.underflow.value
-            overflows += buf.overflow.value
-
-    await cocotb.start(count_excursions())
-
-    in_signals = {
-        'ce': buf.tx_ce,
-        'enable': buf.tx_en,
-        'err': buf.tx_er,
-        'data': buf.txd,
-    }
-    out_signals = {
-        'ce': buf.rx_ce,
-        'err': buf.rx_er,
-        'data': buf.rxd,
-        'valid': buf.rx_dv,
-    }
+    in_bus = MIIBus(buf, 'tx_', enable='tx_en', err='tx_er', data='txd')
+    out_bus = MIIBus(buf, 'rx_', valid='rx_dv', err='rx_er', data='rxd')
 
     for packet in (list(range(10)), [0, 1, 2, None, 4, 5]):
-        await cocotb.start(mii_send_packet(buf, packet, in_signals))
-        assert packet == await alist(mii_recv_packet(buf, out_signals))
+        await cocotb.start(mii_send_packet(buf, packet, in_bus))
+        assert packet == await alist(mii_recv_packet(buf, out_bus))
 
     packet = list(range(10))
     for ratio in (2, 12):
         rx_ce.kill()
         while not buf.tx_ce.value:
             await RisingEdge(buf.clk)
-        rx_ce = await cocotb.start(ClockEnable(buf.clk, buf.rx_ce, ratio))
+        rx_ce.start(ratio)
 
-        underflows = 0
-        overflows = 0
-        await cocotb.start(mii_send_packet(buf, packet, in_signals))
-        outs = await alist(mii_recv_packet(buf, out_signals))
+        underflows.reset()
+        overflows.reset()
+        await cocotb.start(mii_send_packet(buf, packet, in_bus))
+        outs = await alist(mii_recv_packet(buf, out_bus))
         if ratio > 5:
-            assert overflows
+            assert overflows.count
         else:
-            assert underflows
+            assert underflows.count
 
         last = None
         for nibble in outs:
@@ -84,16 +80,100 @@ async def test_elastic(buf):
         await FallingEdge(buf.clk)
         rx_ce.kill()
 
-        underflows = 0
-        overflows = 0
-        await cocotb.start(mii_send_packet(buf, packet, in_signals))
+        await cocotb.start(mii_send_packet(buf, packet, in_bus))
 
         # Set up a worst-case scenario
         while not buf.rx_dv.value:
             await FallingEdge(buf.clk)
         if ratio == 6:
             await ClockCycles(buf.clk, 5, False)
-        rx_ce = await cocotb.start(ClockEnable(buf.clk, buf.rx_ce, ratio))
+        rx_ce.start(ratio)
 
         # And make sure everything works out
-        assert packet == await alist(mii_recv_packet(buf, out_signals))
+        assert packet == await alist(mii_recv_packet(buf, out_bus))
+
+# Stream a few million nibbles through the buffer with the receive clock off by
+# as much as a real link partner's, and see how close we come to over- or
+# underflowing.
+@cocotb.test(timeout_time=250, timeout_unit='ms', skip=skip_slow)
+async def test_drift(buf):
+    await detach_all()
+    buf.clk.value = BinaryValue('Z')
+    buf.tx_ce.value = 0
+    buf.tx_en.value = 0
+    buf.rx_ce.value = 0
+
+    await Timer(1)
+    await cocotb.start(Clock(buf.clk, 8, units='ns').start())
+    await FallingEdge(buf.clk)
+    ClockEnable(buf.clk, buf.tx_ce, 5)
+    rx_ce = ClockEnable(buf.clk, buf.rx_ce, 5)
+
+    in_bus = MIIBus(buf, 'tx_', enable='tx_en', err='tx_er', data='txd')
+    out_bus = MIIBus(buf, 'rx_', valid='rx_dv', err='rx_er', data='rxd')
+
+    metrics = Metrics()
+    StrobeCounter(buf.clk, buf.overflow, metrics=metrics)
+    StrobeCounter(buf.clk, buf.underflow, metrics=metrics)
+
+    # Measure the occupancy from the ports, as the nibbles accepted with tx_ce
+    # minus the nibbles offered with rx_ce. It is recorded each time a nibble is
+    # offered (including that nibble).
+    level = 0
+    occupancy = collections.Counter()
+
+    async def count_in():
+        nonlocal level
+        while True:
+            await RisingEdge(buf.tx_ce)
+            await ReadOnly()
+            if buf.tx_en.value:
+                level += 1
+
+    async def count_out():
+        nonlocal level
+        while True:
+            await RisingEdge(buf.rx_ce)
+            await ReadOnly()
+            if buf.rx_dv.value:
+                occupancy[level] += 1
+                level -= 1
+
+    await cocotb.start(count_in())
+    await cocotb.start(count_out())
+
+    for ppm in (-100, 100):
+        frames = []
+        nibbles = 0
+        while nibbles < 2 ** 21:
+            frames.append(random.randbytes(random.randint(64, 1518)))
+            nibbles += len(frames[-1]) * 2
+
+        async def send_frames():
+            for frame in frames:
+                await mii_send_packet(buf, as_nibbles(frame), in_bus)
+                # Interpacket gap
+                await ClockCycles(buf.tx_ce, 22)
+
+        rx_ce.start(Fraction(5) * (1 + Fraction(ppm, 1000000)))
+        metrics.reset()
+        occupancy.clear()
+        monitor = MIIMonitor(buf, out_bus)
+        packets = monitor.frames()
+        await cocotb.start(send_frames())
+        for frame in frames:
+            assert frame == await anext(packets)
+
+        low = min(occupancy)
+        high = max(occupancy)
+        worst = max(abs(n - WATERMARK) for n in occupancy)
+        print(f"{ppm:+} ppm: {nibbles} nibbles")
+        metrics.report()
+        print("occupancy histogram:")
+        for n in range(low, high + 1):
+            print(f"{n:4} {occupancy[n]}")
+        print(f"occupancy from {low} to {high}: at most {worst} away from the watermark "
+              f"of {WATERMARK}")
+
+        assert metrics.counts() == {'overflow': 0, 'underflow': 0}
+        assert not monitor.errors and not monitor.misaligned
@@ -8,15 +8,15 @@ from cocotb.clock import Clock
 from cocotb.triggers import ClockCycles, Edge, FallingEdge, First, RisingEdge, Timer
 from cocotb.types import LogicArray
 
-from .util import ClockEnable
+from .util import ClockEnable, logic_value
 
 @cocotb.test(timeout_time=500, timeout_unit='ns')
 async def test_io(io):
     io.isolate.value = 0
     io.ce.value = 0
-    io.valid.value = LogicArray('X')
-    io.err.value = LogicArray('X')
-    io.data.value = LogicArray('X' * 4)
+    io.valid.value = logic_value('X')
+    io.err.value = logic_value('X')
+    io.data.value = logic_value('X', 4)
     await Timer(1)
     await cocotb.start(Clock(io.clk, 8, units='ns').start())
     await ClockCycles(io.clk, 1)
@@ -43,9 +43,9 @@ async def test_io(io):
         io.ce.value = 1
         await ClockCycles(io.clk, 2 if early else 1, False)
         io.ce.value = 0
-        io.valid.value = LogicArray('X')
-        io.err.value = LogicArray('X')
-        io.data.value = LogicArray('X' * 4)
+        io.valid.value = logic_value('X')
+        io.err.value = logic_value('X')
+        io.data.value = logic_value('X', 4)
         await ClockCycles(io.clk, delay - 1, early)
 
     async def send_data():
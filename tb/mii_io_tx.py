@@ -8,22 +8,22 @@ from cocotb.clock import Clock
 from cocotb.triggers import ClockCycles, Edge, FallingEdge, First, RisingEdge, Timer
 from cocotb.types import LogicArray
 
-from .util import ClockEnable
+from .util import ClockEnable, logic_value
 
 @cocotb.test(timeout_time=500, timeout_unit='ns')
 async def test_io(io):
     io.isolate.value = 0
-    io.tx_en.value = LogicArray('X')
-    io.tx_er.value = LogicArray('X')
-    io.txd.value = LogicArray('X' * 4)
+    io.tx_en.value = logic_value('X')
+    io.tx_er.value = logic_value('X')
+    io.txd.value = logic_value('X', 4)
     await Timer(1)
     await cocotb.start(Clock(io.clk, 8, units='ns').start())
 
     async def send_datum(enable, err, data):
         await RisingEdge(io.tx_clk)
-        io.tx_en.value = LogicArray('X')
-        io.tx_er.value = LogicArray('X')
-        io.txd.value = LogicArray('X' * 4)
+        io.tx_en.value = logic_value('X')
+        io.tx_er.value = logic_value('X')
+        io.txd.value = logic_value('X', 4)
         await Timer(25, 'ns')
         io.tx_en.value = enable
         io.tx_er.value = err
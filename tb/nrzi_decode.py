@@ -10,13 +10,24 @@ from cocotb.triggers import ClockCycles, FallingEdge, RisingEdge, Timer
 from cocotb.types import LogicArray
 
 from .nrzi_encode import nrzi_encode
-from .util import alist, async_iter, compare_lists, timeout, send_recovered_bits, with_valids, print_list_at
+from .util import GENMASK, alist, async_iter, compare_lists, timeout, send_recovered_bits, with_valids, print_list_at
+
+class NRZIDecoder:
+    def __init__(self, last=1):
+        self.last = last
+
+    def decode(self, value, length):
+        mask = GENMASK(length - 1, 0)
+        value &= mask
+        prev = (value << 1 | self.last) & mask
+        if length:
+            self.last = value >> (length - 1)
+        return value ^ prev, length
 
 async def nrzi_decode(bits):
-    last = 1
+    decoder = NRZIDecoder()
     async for bit in bits:
-        yield bit ^ last
-        last = bit
+        yield decoder.decode(int(bit), 1)[0]
 
 @timeout(10, 'us')
 async def test_rx(decoder, valids):
@@ -1,18 +1,39 @@
 # SPDX-License-Identifier: AGPL-3.0-Only
 # Copyright (C) 2022 Sean Anderson <seanga2@gmail.com>
 
+import itertools
 import random
 
 import cocotb
 from cocotb.clock import Clock
 from cocotb.triggers import FallingEdge, RisingEdge, Timer
 
-from .util import compare_lists
-
-def nrzi_encode(bits):
-    last = 1
-    for bit in bits:
-        yield (last := last ^ bit)
+from .util import GENMASK, compare_lists, pack_bits, unpack_bits
+
+class NRZIEncoder:
+    def __init__(self, last=1):
+        self.last = last
+
+    def encode(self, value, length):
+        # Each output bit is the XOR of all the input bits up to it
+        shift = 1
+        while shift < length:
+            value ^= value << shift
+            shift <<= 1
+
+        mask = GENMASK(length - 1, 0)
+        value &= mask
+        if self.last:
+            value ^= mask
+        if length:
+            self.last = value >> (length - 1)
+        return value, length
+
+def nrzi_encode(bits, block=256):
+    encoder = NRZIEncoder()
+    bits = iter(bits)
+    while chunk := list(itertools.islice(bits, block)):
+        yield from unpack_bits(*encoder.encode(*pack_bits(chunk)))
 
 @cocotb.test(timeout_time=100, timeout_unit='us')
 async def test_encode(encoder):
@@ -4,7 +4,7 @@
 import enum
 import itertools
 
-from .util import classproperty
+from .util import bits_to_str, str_to_bits
 
 class Code(enum.Enum):
     _0 = (0b11110, '0')
@@ -46,16 +46,13 @@ class Code(enum.Enum):
 
     @classmethod
     def decode(cls, bits):
+        if isinstance(bits, int):
+            return _decode[bits]
+
         value = 0
         for bit in bits:
-            value = (value << 1) | bit
-        return cls(value)
-
-    @classproperty
-    def encode(cls):
-        if not hasattr(cls, '_encode'):
-            cls._encode = { data: cls(f"{data:X}") for data in range(16) }
-        return cls._encode
+            value = (value << 1) | int(bit)
+        return _decode[value]
 
     def __new__(cls, code, name):
         self = object.__new__(cls)
@@ -68,6 +65,8 @@ class Code(enum.Enum):
             self.data = int(name, 16)
         except ValueError:
             self.data = None
+        self.bits = tuple((code >> bit) & 1 for bit in range(4, -1, -1))
+        self.symbol = ''.join(map(str, self.bits))
 
     def __hash__(self):
         return hash(self.value)
@@ -87,12 +86,37 @@ class Code(enum.Enum):
         return f"/{self._name_}/"
 
     def __iter__(self):
-        code = self.value
-        for _ in range(5):
-            yield (code & 0x10) >> 4
-            code <<= 1
+        return iter(self.bits)
+
+_decode = tuple(Code(value) for value in range(32))
+Code.encode = tuple(Code(f"{data:X}") for data in range(16))
+
+# Codes keyed by their bits (in transmit order) as a string. This lets whole
+# buffers be converted with a single join.
+SYMBOLS = { code.symbol: code for code in Code }
+_symbol_data = { symbol: code.data for symbol, code in SYMBOLS.items() }
+_symbol_strs = { code: code.symbol for code in Code }
+_symbol_strs.update((data, code.symbol) for data, code in enumerate(Code.encode))
+_symbol_strs[None] = Code('H').symbol
+_byte_strs = tuple(_symbol_strs[byte >> 4] + _symbol_strs[byte & 0xf]
+                   for byte in range(256))
 
 def as_nibbles(data):
     for byte in data:
        yield byte >> 4
        yield byte & 0xf
+
+def encode_symbols(data):
+    if isinstance(data, (bytes, bytearray)):
+        return str_to_bits(''.join(map(_byte_strs.__getitem__, data)))
+    return str_to_bits(''.join(map(_symbol_strs.__getitem__, data)))
+
+def _split_symbols(value, length):
+    bits = bits_to_str(value, length - length % 5)
+    return (bits[i:i + 5] for i in range(0, len(bits), 5))
+
+def decode_symbols(value, length):
+    return list(map(SYMBOLS.__getitem__, _split_symbols(value, length)))
+
+def decode_nibbles(value, length):
+    return list(map(_symbol_data.__getitem__, _split_symbols(value, length)))
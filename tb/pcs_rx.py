@@ -8,13 +8,16 @@ from cocotb.clock import Clock
 from cocotb.triggers import RisingEdge, FallingEdge, Timer
 from cocotb.types import LogicArray
 
-from .pcs import Code, as_nibbles
-from .util import alist, send_recovered_bits, timeout, with_valids
+from .descramble import Keystream
+from .nrzi_encode import NRZIEncoder
+from .pcs import Code, as_nibbles, encode_symbols
+from .util import GENMASK, MIIBus, alist, send_recovered_bits, timeout, with_valids
 
 def as_codes(nibbles):
+    H = Code('H')
     for nibble in nibbles:
         if nibble is None:
-            yield Code('H')
+            yield H
         else:
             yield Code.encode[nibble]
 
@@ -26,25 +29,95 @@ def frame(data):
         (Code('T'), Code('R')),
     )
 
-async def mii_recv_packet(pcs, signals=None):
-    if signals is None:
-        signals = {
-            'ce': pcs.ce,
-            'err': pcs.err,
-            'data': pcs.data,
-            'valid': pcs.valid,
-        }
-
-    while not (signals['ce'].value and signals['valid'].value):
-        await RisingEdge(pcs.clk)
-
-    while signals['valid'].value:
-        if signals['ce'].value:
-            if 'err' in signals and signals['err'].value:
+# A model of the transmit half of a PHY. Items are either a number of idle bits
+# or a frame (as bytes or nibbles). Each item is emitted as soon as it is
+# encoded, in (value, length) chunks of at most block bits.
+class LineEncoder:
+    def __init__(self, nrzi=True, block=4096):
+        self.keystream = Keystream()
+        self.nrzi = NRZIEncoder() if nrzi else None
+        self.block = block
+
+    def line(self, value, length):
+        value = self.keystream.scramble(value, length) & GENMASK(length - 1, 0)
+        if self.nrzi:
+            return self.nrzi.encode(value, length)
+        return value, length
+
+    def encode(self, items):
+        for item in items:
+            if isinstance(item, int):
+                while item:
+                    length = min(item, self.block)
+                    yield self.line(GENMASK(length - 1, 0), length)
+                    item -= length
+                continue
+
+            if isinstance(item, (bytes, bytearray)):
+                item = as_nibbles(item)
+            value, length = encode_symbols(frame(item))
+            for start in range(0, length, self.block):
+                chunk = min(length - start, self.block)
+                yield self.line(value >> start, chunk)
+
+async def mii_recv_packet(pcs, bus=None):
+    if bus is None:
+        bus = MIIBus(pcs)
+
+    while not (bus.ce.value and bus.valid.value):
+        await RisingEdge(bus.clk)
+
+    while bus.valid.value:
+        if bus.ce.value:
+            if bus.err is not None and bus.err.value:
                 yield None
             else:
-                yield signals['data'].value
-        await RisingEdge(pcs.clk)
+                yield bus.data.value
+        await RisingEdge(bus.clk)
+
+# An event-driven version of mii_recv_packet which returns frames as bytes.
+# Nibbles are packed high nibble first, like as_nibbles. Between frames we wait
+# for valid, and within them we only wake up around clock enables. Nibbles
+# with err set are counted in errors, and their frames are returned as None.
+# Frames with an odd number of nibbles are counted in misaligned, and their
+# last nibble is dropped.
+class MIIMonitor:
+    def __init__(self, pcs, bus=None):
+        self.bus = MIIBus(pcs) if bus is None else bus
+        self.errors = 0
+        self.misaligned = 0
+
+    async def strobe(self):
+        while True:
+            await RisingEdge(self.bus.clk)
+            if self.bus.ce.value:
+                return
+            await RisingEdge(self.bus.ce)
+
+    async def frames(self):
+        bus = self.bus
+        while True:
+            await self.strobe()
+            while not bus.valid.value:
+                await RisingEdge(bus.valid)
+                await self.strobe()
+
+            nibbles = bytearray()
+            errors = self.errors
+            while bus.valid.value:
+                if bus.err is not None and bus.err.value:
+                    self.errors += 1
+                    nibbles.append(0)
+                else:
+                    nibbles.append(int(bus.data.value))
+                await self.strobe()
+
+            if len(nibbles) & 1:
+                self.misaligned += 1
+            if self.errors != errors:
+                yield None
+            else:
+                yield bytes(hi << 4 | lo for hi, lo in zip(nibbles[::2], nibbles[1::2]))
 
 async def pcs_send_codes(pcs, codes, valids):
     await send_recovered_bits(pcs.clk, pcs.bits, pcs.bits_valid,
@@ -1,37 +1,37 @@
 # SPDX-License-Identifier: AGPL-3.0-Only
 # Copyright (C) 2022 Sean Anderson <seanga2@gmail.com>
 
+import re
+
 import cocotb
 from cocotb.clock import Clock
 from cocotb.triggers import ClockCycles, RisingEdge, FallingEdge, Timer
 from cocotb.types import LogicArray
 
-from .pcs import Code, as_nibbles
-from .util import alist, ClockEnable, ReverseList
+from .nrzi_decode import NRZIDecoder
+from .pcs import SYMBOLS, Code, as_nibbles, encode_symbols
+from .scramble import Descrambler
+from .util import GENMASK, MIIBus, Pipeline, alist, bits_to_str, ClockEnable, ShiftRegister, \
+                   detach_all, logic_value
 
-async def mii_send_packet(pcs, nibbles, signals=None):
-    if signals is None:
-        signals = {
-            'ce': pcs.ce,
-            'enable': pcs.enable,
-            'err': pcs.err,
-            'data': pcs.data,
-        }
+async def mii_send_packet(pcs, nibbles, bus=None):
+    if bus is None:
+        bus = MIIBus(pcs)
 
-    await FallingEdge(signals['ce'])
+    await FallingEdge(bus.ce)
     for nibble in nibbles:
-        signals['enable'].value = 1
-        signals['err'].value = 0
+        bus.enable.value = 1
+        bus.err.value = 0
         if nibble is None:
-            signals['err'].value = 1
+            bus.err.value = 1
         else:
-            signals['data'].value = nibble
-        await FallingEdge(signals['ce'])
+            bus.data.value = nibble
+        await FallingEdge(bus.ce)
 
-    signals['enable'].value = 0
-    signals['err'].value = 0
-    signals['data'].value = LogicArray("XXXX")
-    await FallingEdge(signals['ce'])
+    bus.enable.value = 0
+    bus.err.value = 0
+    bus.data.value = logic_value('X', 4)
+    await FallingEdge(bus.ce)
 
 class PCSError(Exception):
     pass
@@ -54,7 +54,8 @@ async def pcs_recv_packet(pcs, bits=None):
     if bits is None:
         bits = pcs_recv_bits(pcs)
 
-    rx_bits = ReverseList([1] * 10)
+    rx_bits = ShiftRegister(10, GENMASK(9, 0))
+    I, J, K, T, R = map(Code, 'IJKTR')
 
     async def read_bit():
         rx_bits.append(await anext(bits))
@@ -64,40 +65,165 @@ async def pcs_recv_packet(pcs, bits=None):
             await read_bit()
 
     async def bad_ssd():
-        while not all(rx_bits[9:0]):
+        while not rx_bits.all(9, 0):
             await read_bit()
-        raise BadSSDError()
+        raise BadSSD()
 
-    while all(rx_bits[9:2]) or rx_bits[0]:
+    while rx_bits.all(9, 2) or rx_bits[0]:
         await read_bit()
 
-    if Code.decode(rx_bits[9:5]) != Code('I') or \
-       Code.decode(rx_bits[4:0]) != Code('J'):
+    if rx_bits[9:5] != I.value or rx_bits[4:0] != J.value:
         await bad_ssd()
 
     await read_code()
-    if Code.decode(rx_bits[4:0]) != Code('K'):
+    if rx_bits[4:0] != K.value:
         await bad_ssd()
 
     yield 0x5
     await read_code()
 
     yield 0x5
-    while any(rx_bits[9:0]):
+    while rx_bits.any(9, 0):
         await read_code()
         code = Code.decode(rx_bits[9:5])
-        if code == Code('T') and Code.decode(rx_bits[4:0]) == Code('R'):
+        if code == T and rx_bits[4:0] == R.value:
             return
         yield code.data
-    raise PrematureEndError()
+    raise PrematureEnd()
+
+# A synchronous version of pcs_recv_packet which works on blocks of bits. Bits
+# are kept as a string, along with the ten bits before the current position.
+class PCSDecoder:
+    SSD = Code('I').symbol + Code('J').symbol
+    K = Code('K').symbol
+    DATA = { symbol: code.data for symbol, code in SYMBOLS.items() }
+    CODE = re.compile('.{5}')
+    TR = re.compile(f"(?:.{{5}})*?{Code('T').symbol}{Code('R').symbol}")
+    IDLE = re.compile(f"(?:.{{5}})*?{Code('I').symbol * 2}")
+
+    def __init__(self):
+        self.bits = ''
+        self.pos = 0
+        self.frames = []
+        # Carrier without /I/J/
+        self.false_carriers = 0
+        # /J/ without /K/
+        self.bad_ssds = 0
+        # Frames which ended with /I/I/ instead of /T/R/. These are still
+        # returned, ending with an error.
+        self.premature_ends = 0
+        # Non-data codes within frames
+        self.symbol_errors = 0
+        self.reset()
+
+    def reset(self):
+        self.bits = '1' * 10 + self.bits[self.pos:]
+        self.pos = 10
+        self.state = self.idle
+
+    def idle(self):
+        while (pos := self.bits.find('0', self.pos)) >= 0:
+            self.pos = pos + 1
+            if '0' in self.bits[pos - 9:pos - 1]:
+                if self.bits[pos - 9:pos + 1] == self.SSD:
+                    self.state = self.start
+                else:
+                    self.false_carriers += 1
+                    self.state = self.wait_idle
+                return True
+        self.pos = len(self.bits)
+        return False
+
+    def start(self):
+        if len(self.bits) - self.pos < 10:
+            return False
+
+        if self.bits[self.pos:self.pos + 5] != self.K:
+            self.pos += 5
+            self.bad_ssds += 1
+            self.state = self.wait_idle
+            return True
+
+        self.pos += 10
+        self.frame = [0x5, 0x5]
+        self.state = self.data
+        return True
+
+    def data(self):
+        # Find the first /T/R/ or /I/I/. Until then, every code is data. Like
+        # the PCS, the first /I/ of a premature end is received as an error,
+        # and we go back to looking for /J/K/ after the second one.
+        end = self.pos + (len(self.bits) - self.pos) // 5 * 5
+        tr = self.TR.match(self.bits, self.pos - 5, end)
+        idle = self.IDLE.match(self.bits, self.pos - 5, end)
+        stop = end
+        if idle:
+            stop = idle.end()
+        if tr and tr.end() - 5 < stop:
+            stop = tr.end() - 5
+            idle = None
+
+        data = list(map(self.DATA.__getitem__,
+                        self.CODE.findall(self.bits, self.pos - 5, stop - 5)))
+        self.symbol_errors += data.count(None)
+        self.frame.extend(data)
+        self.pos = stop
+
+        if idle:
+            self.premature_ends += 1
+            self.frames.append(self.frame)
+            self.reset()
+            return True
+        elif tr:
+            self.pos += 5
+            self.frames.append(self.frame)
+            self.reset()
+            return True
+        return False
+
+    def wait_idle(self):
+        pos = self.bits.find('1' * 10, self.pos - 10)
+        if pos < 0:
+            self.pos = len(self.bits)
+            return False
+
+        self.pos = pos + 10
+        self.reset()
+        return True
+
+    def decode(self, value, length):
+        self.bits += bits_to_str(value, length)
+        while self.state():
+            pass
+
+        self.bits = self.bits[self.pos - 10:]
+        self.pos = 10
+        frames, self.frames = self.frames, []
+        return frames
+
+# A model of the receive half of a PHY. Frames are returned as lists of
+# nibbles, with None for errors. The PCS error counters are in pcs.
+class LineDecoder(Pipeline):
+    def __init__(self, nrzi=True):
+        self.descrambler = Descrambler()
+        self.pcs = PCSDecoder()
+        stages = (self.descrambler.descramble, self.pcs.decode)
+        if nrzi:
+            stages = (NRZIDecoder().decode, *stages)
+        super().__init__(*stages)
+
+    def decode(self, chunks):
+        for chunk in chunks:
+            yield from self(*chunk)
 
 @cocotb.test(timeout_time=10, timeout_unit='us')
 async def test_tx(pcs):
+    await detach_all()
     pcs.enable.value = 0
     pcs.err.value = 0
     pcs.data.value = LogicArray("XXXX")
     pcs.link_status.value = 1
-    await cocotb.start(ClockEnable(pcs.clk, pcs.ce, 5))
+    ClockEnable(pcs.clk, pcs.ce, 5)
     await Timer(1)
     await cocotb.start(Clock(pcs.clk, 8, units='ns').start())
     await FallingEdge(pcs.ce)
@@ -114,3 +240,25 @@ async def test_tx(pcs):
     assert [0x5, 0x5, None] == await alist(pcs_recv_packet(pcs))
     await cocotb.start(mii_send_packet(pcs, [0x5, None]))
     assert [0x5, 0x5, None] == await alist(pcs_recv_packet(pcs))
+
+@cocotb.test()
+async def test_decoder(pcs):
+    def codes(*names):
+        return [Code(name) for name in names]
+
+    # A frame ended by /I/I/, followed by a good one
+    symbols = codes('I', 'I', 'J', 'K', '1', '2', 'I', 'I', 'I', 'I', 'J', 'K', '3', '4', 'T',
+                    'R', 'I', 'I')
+    value, length = encode_symbols(symbols)
+
+    # Try different alignments between the blocks and the codes
+    for block in (1, 3, 5, 7, length):
+        decoder = PCSDecoder()
+        frames = []
+        for start in range(0, length, block):
+            frames.extend(decoder.decode(value >> start, min(block, length - start)))
+
+        assert frames == [[0x5, 0x5, 0x1, 0x2, None], [0x5, 0x5, 0x3, 0x4]]
+        assert decoder.premature_ends == 1
+        assert decoder.symbol_errors == 1
+        assert not decoder.false_carriers and not decoder.bad_ssds
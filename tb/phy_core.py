@@ -6,17 +6,17 @@ import random
 
 import cocotb
 from cocotb.clock import Clock
-from cocotb.triggers import ClockCycles, Event, FallingEdge, RisingEdge, Timer
+from cocotb.triggers import ClockCycles, Event, FallingEdge, Timer
 from cocotb.types import LogicArray
 
-from .scramble import descramble
-from .descramble import scramble
-from .pcs_tx import as_nibbles, mii_send_packet, pcs_recv_packet
-from .pcs_rx import frame, mii_recv_packet
-from .util import alist, ClockEnable
+from .pcs_tx import LineDecoder, as_nibbles, mii_send_packet
+from .pcs_rx import LineEncoder, MIIMonitor
+from .util import RECOVERED_BITS, alist, ClockEnable, Metrics, MIIBus, recv_frames, \
+    StrobeCounter, detach_all, unpack_bits
 
 @cocotb.test(timeout_time=15, timeout_unit='us')
 async def test_transfer(phy):
+    await detach_all()
     phy.coltest.value = 0
     phy.descrambler_test_mode.value = 0
     phy.tx_en.value = 0
@@ -24,68 +24,61 @@ async def test_transfer(phy):
     phy.signal_status.value = 0
     phy.loopback.value = 0
     phy.link_monitor_test_mode.value = 1
-    await cocotb.start(ClockEnable(phy.clk, phy.tx_ce, 5))
+    ClockEnable(phy.clk, phy.tx_ce, 5)
     await Timer(1)
     await cocotb.start(Clock(phy.clk, 8, units='ns').start())
     await FallingEdge(phy.clk)
     phy.signal_status.value = 1
 
-    tx_data = list(as_nibbles([0x55, 0x01, 0x23, 0x45, 0x67, 0x89, 0xab, 0xcd, 0xef]))
-    rx_data = list(as_nibbles((0x55, 0xfe, 0xdc, 0xba, 0x98, 0x76, 0x54, 0x32, 0x10)))
+    tx_bytes = bytes((0x55, 0x01, 0x23, 0x45, 0x67, 0x89, 0xab, 0xcd, 0xef))
+    rx_bytes = bytes((0x55, 0xfe, 0xdc, 0xba, 0x98, 0x76, 0x54, 0x32, 0x10))
+    tx_data = list(as_nibbles(tx_bytes))
+    rx_data = list(as_nibbles(rx_bytes))
 
     async def send_rx_packets():
-        def rx_bits():
-            packet_bits = list(itertools.chain.from_iterable(frame(rx_data)))
-
+        def rx_items():
             # First packet is OK, second is a collision
-            yield from itertools.repeat(1, 120)
-            yield from packet_bits
-            yield from itertools.repeat(1, 240)
-            yield from packet_bits
+            yield from (120, rx_data, 240, rx_data)
 
             while not phy.loopback.value:
                 yield 1
 
-        for bit in scramble(rx_bits()):
-            phy.rx_data.value = LogicArray((bit, 'X'))
-            phy.rx_data_valid.value = 1
-            await FallingEdge(phy.clk)
+        for chunk in LineEncoder(nrzi=False).encode(rx_items()):
+            for bit in unpack_bits(*chunk):
+                phy.rx_data.value = RECOVERED_BITS[bit, 'X']
+                phy.rx_data_valid.value = 1
+                await FallingEdge(phy.clk)
 
     async def send_tx_packets():
-        signals = {
-            'ce': phy.tx_ce,
-            'enable': phy.tx_en,
-            'err': phy.tx_er,
-            'data': phy.txd,
-        }
+        bus = MIIBus(phy, 'tx_', enable='tx_en', err='tx_er', data='txd')
 
         # Send a packet, and then cause a collision
         await ClockCycles(phy.clk, 240)
-        await mii_send_packet(phy, tx_data, signals)
+        await mii_send_packet(phy, tx_data, bus)
         await ClockCycles(phy.clk, 120)
-        await mii_send_packet(phy, tx_data, signals)
+        await mii_send_packet(phy, tx_data, bus)
 
         while not phy.loopback.value:
             await FallingEdge(phy.clk)
 
         # Loopback
         await ClockCycles(phy.clk, 120)
-        await mii_send_packet(phy, tx_data, signals)
+        await mii_send_packet(phy, tx_data, bus)
 
         # Collision test
         await ClockCycles(phy.clk, 120)
         phy.coltest.value = 1
-        await mii_send_packet(phy, tx_data, signals)
+        await mii_send_packet(phy, tx_data, bus)
         
         while phy.loopback.value:
             await FallingEdge(phy.clk)
 
         await ClockCycles(phy.clk, 240)
-        await mii_send_packet(phy, tx_data, signals)
+        await mii_send_packet(phy, tx_data, bus)
 
     async def loopback():
         while phy.loopback.value:
-            phy.rx_data.value = LogicArray((int(phy.tx_data.value), 'X'))
+            phy.rx_data.value = RECOVERED_BITS[int(phy.tx_data.value), 'X']
             await FallingEdge(phy.clk)
 
     await cocotb.start(send_tx_packets())
@@ -95,36 +88,22 @@ async def test_transfer(phy):
     tx_ready = Event()
 
     async def recv_rx_packets():
-        async def packets():
-            while True:
-                yield await alist(mii_recv_packet(phy, {
-                    'ce': phy.rx_ce,
-                    'err': phy.rx_er,
-                    'data': phy.rxd,
-                    'valid': phy.rx_dv,
-                }))
-    
-        packets = packets()
-        assert rx_data == await anext(packets)
-        assert rx_data == await anext(packets)
+        monitor = MIIMonitor(phy, MIIBus(phy, 'rx_', valid='rx_dv', err='rx_er', data='rxd'))
+        packets = monitor.frames()
+
+        assert rx_bytes == await anext(packets)
+        assert rx_bytes == await anext(packets)
         rx_ready.set()
-        assert tx_data == await anext(packets)
-        assert tx_data == await anext(packets)
+        assert tx_bytes == await anext(packets)
+        assert tx_bytes == await anext(packets)
         rx_ready.set()
-        assert rx_data == await anext(packets)
+        assert rx_bytes == await anext(packets)
         rx_ready.set()
+        assert not monitor.errors and not monitor.misaligned
 
     async def recv_tx_packets():
-        async def recv():
-            while True:
-                await RisingEdge(phy.clk)
-                yield phy.tx_data.value
-
-        async def packets():
-            while True:
-                yield await alist(pcs_recv_packet(phy, descramble(recv())))
+        packets = recv_frames(phy.clk, phy.tx_data, LineDecoder(nrzi=False))
 
-        packets = packets()
         assert tx_data == await anext(packets)
         assert tx_data == await anext(packets)
         tx_ready.set()
@@ -137,34 +116,13 @@ async def test_transfer(phy):
     await cocotb.start(recv_rx_packets())
     await cocotb.start(recv_tx_packets())
 
-    crs = 0
-    col = 0
-
-    async def count_crs():
-        nonlocal crs
-        last_crs = 0
-        while True:
-            await RisingEdge(phy.clk)
-            if phy.crs.value and not last_crs:
-                crs += 1
-            last_crs = phy.crs.value
-
-    async def count_col():
-        nonlocal col
-        last_col = 0
-        while True:
-            await RisingEdge(phy.clk)
-            if phy.col.value and not last_col:
-                col += 1
-            last_col = phy.col.value
-
-    await cocotb.start(count_crs())
-    await cocotb.start(count_col())
+    metrics = Metrics()
+    StrobeCounter(phy.clk, phy.crs, edges=True, metrics=metrics)
+    StrobeCounter(phy.clk, phy.col, edges=True, metrics=metrics)
 
     await rx_ready.wait()
     await tx_ready.wait()
-    assert crs == 3
-    assert col == 1
+    assert metrics.counts() == {'crs': 3, 'col': 1}
     rx_ready.clear()
     tx_ready.clear()
 
@@ -174,8 +132,7 @@ async def test_transfer(phy):
 
     await rx_ready.wait()
     await tx_ready.wait()
-    assert crs == 5
-    assert col == 2
+    assert metrics.counts() == {'crs': 5, 'col': 2}
     rx_ready.clear()
     tx_ready.clear()
 
@@ -186,5 +143,4 @@ async def test_transfer(phy):
 
     await rx_ready.wait()
     await tx_ready.wait()
-    assert crs == 7
-    assert col == 2
+    assert metrics.counts() == {'crs': 7, 'col': 2}
@@ -10,7 +10,7 @@ from cocotb.clock import Clock
 from cocotb.regression import TestFactory
 from cocotb.triggers import RisingEdge, Timer
 
-from .util import compare_lists, print_list_at, timeout
+from .util import align, compare_lists, print_list_at, timeout
 
 BITS = 1000
 
@@ -41,14 +41,7 @@ async def check_bits(pmd, ins):
             outs.append(pmd.rx_data[1].value)
             outs.append(pmd.rx_data[0].value)
 
-    best_corr = -1
-    best_off = None
-    for off in range(16):
-        corr = sum(i == o for i, o in zip(ins[off:], outs))
-        if corr > best_corr:
-            best_corr = corr
-            best_off = off
-
+    best_off, best_corr = align(ins, outs, range(16))
     print(f"best offset is {best_off} correlation {best_corr/(len(ins) - best_off)}")
     compare_lists(ins[best_off:], outs)
     # There will be a few bits at the end not recorded because signal_detect
@@ -8,30 +8,60 @@ import cocotb
 from cocotb.clock import Clock
 from cocotb.triggers import FallingEdge, RisingEdge, Timer
 
-from .util import alist, ReverseList, print_list_at, compare_lists
+from .descramble import LFSR_MASK, LFSR_WIDTH, TAPS, Keystream, bitrev
+from .util import GENMASK, alist, compare_lists, pack_bits, unpack_bits
 
 threshold = 32
 
-async def descramble(scrambled):
-    consecutive = 0
-    locked = False
-    lfsr = ReverseList([0] * 11)
-    async for s in scrambled:
-        ldd = lfsr[8] ^ lfsr[10]
+class Descrambler:
+    def __init__(self):
+        self.locked = False
+        self.consecutive = 0
+        # Until we lock, this holds the inverse of the last bits received
+        self.keystream = Keystream(0)
 
-        if s ^ ldd:
-            consecutive += 1
-        else:
-            consecutive = 0
+    def descramble(self, value, length):
+        if self.locked:
+            return self.keystream.scramble(value, length), length
 
-        if consecutive >= threshold:
-            locked = True
+        # While idle, the unscrambled data is all ones, so the inverse of the
+        # scrambled data is the keystream. Each bit is "good" if it matches
+        # what the LFSR would have predicted from the bits before it.
+        mask = GENMASK(length - 1, 0)
+        seq = bitrev(self.keystream.state, LFSR_WIDTH) | (~value & mask) << LFSR_WIDTH
+        predicted = seq
+        for tap in TAPS:
+            predicted ^= seq << tap + 1
+        good = ~predicted >> LFSR_WIDTH & mask
 
-        if locked:
-            yield s ^ ldd
-            lfsr.append(ldd)
-        else:
-            lfsr.append(0 if s else 1)
+        # Find the first run of threshold good bits, including the ones
+        # left over from the last block
+        good = good << self.consecutive | GENMASK(self.consecutive - 1, 0)
+        total = length + self.consecutive
+        runs = good
+        width = 1
+        while width < threshold:
+            shift = min(width, threshold - width)
+            runs &= runs >> shift
+            width += shift
+
+        if not runs:
+            bad = ~good & GENMASK(total - 1, 0)
+            self.consecutive = total - bad.bit_length()
+            self.keystream.state = bitrev(seq >> length & LFSR_MASK, LFSR_WIDTH)
+            return 0, 0
+
+        # The bit which completes the run is the first one descrambled
+        lock = (runs & -runs).bit_length() + threshold - 2 - self.consecutive
+        self.locked = True
+        self.keystream.state = bitrev(seq >> lock & LFSR_MASK, LFSR_WIDTH)
+        return self.keystream.scramble(value >> lock, length - lock), length - lock
+
+async def descramble(blocks):
+    descrambler = Descrambler()
+    async for block in blocks:
+        for bit in unpack_bits(*descrambler.descramble(*pack_bits(block))):
+            yield bit
 
 @cocotb.test(timeout_time=10, timeout_unit='us')
 async def test_scramble(scrambler):
@@ -52,4 +82,5 @@ async def test_scramble(scrambler):
             await RisingEdge(scrambler.clk)
             yield scrambler.scrambled.value
 
-    compare_lists(ins[idles-1:], await alist(descramble(recv())))
+    outs = Descrambler().descramble(*pack_bits(await alist(recv())))
+    compare_lists(ins[idles-1:], unpack_bits(*outs))
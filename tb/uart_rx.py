@@ -2,30 +2,88 @@
 # Copyright (C) 2023 Sean Anderson <seanga2@gmail.com>
 
 import cocotb
+from cocotb import simulator
 from cocotb.binary import BinaryValue
 from cocotb.clock import Clock
+from cocotb.handle import SimHandle
 from cocotb.regression import TestFactory
-from cocotb.triggers import FallingEdge, Timer
+from cocotb.triggers import Edge, FallingEdge, Timer
 from cocotb.utils import get_sim_time, get_sim_steps
 
 from .axis_replay_buffer import recv_packet
-from .util import ClockEnable, timeout
+from .util import AXISBus, BIT, ClockEnable, GENMASK, StrobeCounter, attached, detach_all, \
+    timeout
 
 BAUD = 4e6
-BIT_STEPS = get_sim_steps(1 / BAUD, 'sec', round_mode='round')
 
-def as_bits(c):
-    for _ in range(8):
-        yield c & 1
-        c >>= 1
-
-async def putchar(rx, c):
-    for bit in (0, *as_bits(c), 1):
-        rx.value = bit
-        await Timer(BIT_STEPS)
+# Find the BFM in rtl/uart_bfms.v for signal (named after it), if there is one
+def uart_bfm(signal):
+    root = simulator.get_root_handle('uart_bfms')
+    if root:
+        return getattr(SimHandle(root), signal._name, None)
+
+# A UART transmitter driving signal. skew is the fractional error in the baud
+# rate (e.g. 0.01 is 1% fast). If the simulation has a uart_source for signal,
+# each frame is handed off to it whole, and we only wake up once it has been
+# sent. Otherwise, we drive signal ourselves, waking up whenever it changes.
+class UARTSource:
+    def __init__(self, signal, baud=BAUD, stop_bits=1, skew=0):
+        self.signal = signal
+        self.stop_bits = stop_bits
+        self.baud = baud * (1 + skew)
+        self.sent = 0
+        self.elapsed = 0
+        self.bfm = uart_bfm(signal)
+
+    # Send length bits of value, LSB first
+    async def send_bits(self, value, length):
+        if self.bfm is None:
+            steps = get_sim_steps(1, 'sec') / self.baud
+            start = get_sim_time()
+            bit = 0
+            while bit < length:
+                level = value >> bit & 1
+                end = bit + 1
+                while end < length and (value >> end & 1) == level:
+                    end += 1
+                self.signal.value = level
+                await Timer(round(start + end * steps) - get_sim_time())
+                bit = end
+            return
+
+        done = Edge(self.bfm.done)
+        self.bfm.frame.value = value
+        self.bfm.bits.value = length
+        self.bfm.period.value = 1e9 / self.baud
+        self.bfm.attach.value = 1
+        attached[self.signal._name] = self
+        self.bfm.start.value = int(self.bfm.start.value) ^ 1
+        await done
+
+    # Send each byte of data back-to-back
+    async def send(self, data):
+        start = get_sim_time('sec')
+        stop = GENMASK(self.stop_bits + 8, 9)
+        for c in data:
+            await self.send_bits(c << 1 | stop, self.stop_bits + 9)
+            self.sent += 1
+        self.elapsed += get_sim_time('sec') - start
+
+    async def send_break(self, bits=20):
+        await self.send_bits(BIT(bits), bits + 1)
+
+    # Bytes per second while sending
+    def rate(self):
+        return self.sent / self.elapsed if self.elapsed else 0
+
+    # Let signal be driven directly again
+    def detach(self):
+        if attached.pop(self.signal._name, None) is not None:
+            self.bfm.attach.value = 0
 
 @timeout(1, 'ms')
 async def test_rx(uart, ratio):
+    await detach_all()
     uart.clk.value = BinaryValue('Z')
     uart.rst.value = 1
     uart.ready.value = 0
@@ -36,52 +94,32 @@ async def test_rx(uart, ratio):
     uart.rst.value = 0
     await cocotb.start(Clock(uart.clk, 8, units='ns').start())
     await FallingEdge(uart.clk)
-    ce = await cocotb.start(ClockEnable(uart.clk, uart.ready, ratio))
+    ce = ClockEnable(uart.clk, uart.ready, ratio)
 
     msg = b"Hell\0"
-    signals = {
-        'clk': uart.clk,
-        'data': uart.data,
-        'valid': uart.valid,
-        'ready': uart.ready,
-    }
-
-    await cocotb.start(recv_packet(signals, msg))
-    for c in msg:
-        await putchar(uart.rx, c)
-
-    overflows = 0
-    frame_errors = 0
+    bus = AXISBus(uart)
 
-    async def count_errors():
-        nonlocal overflows
-        nonlocal frame_errors
-        while True:
-            await FallingEdge(uart.clk)
-            overflows += uart.overflow.value
-            frame_errors += uart.frame_error.value
+    source = UARTSource(uart.rx)
 
-    monitor = await cocotb.start(count_errors())
+    await cocotb.start(recv_packet(bus, msg))
+    await source.send(msg)
 
-    uart.rx.value = 0
-    await Timer(BIT_STEPS * 20)
+    overflows = StrobeCounter(uart.clk, uart.overflow)
+    frame_errors = StrobeCounter(uart.clk, uart.frame_error)
 
-    uart.rx.value = 1
-    await Timer(BIT_STEPS)
-
-    assert frame_errors == 1
+    await source.send_break()
+    assert frame_errors.count == 1
 
-    ce.kill()
-    uart.ready.value = 0
-    await putchar(uart.rx, 0xFF)
-    await putchar(uart.rx, 0)
+    ce.set(0)
+    await source.send((0xFF, 0))
 
-    assert overflows == 1
+    assert overflows.count == 1
 
-    uart.ready.value = 1
-    await recv_packet(signals, (0xFF,))
+    ce.set(1)
+    await recv_packet(bus, (0xFF,))
 
-    monitor.kill()
+    overflows.kill()
+    frame_errors.kill()
 
 uart_tests = TestFactory(test_rx)
 uart_tests.add_option('ratio', (1, 4))
@@ -4,34 +4,82 @@
 import cocotb
 from cocotb.binary import BinaryValue
 from cocotb.clock import Clock
+from cocotb.queue import Queue
 from cocotb.regression import TestFactory
-from cocotb.triggers import FallingEdge, Timer
+from cocotb.triggers import Edge, FallingEdge, Timer
 from cocotb.utils import get_sim_time, get_sim_steps
 
 from .axis_replay_buffer import send_packet
-from .util import timeout
+from .uart_rx import BAUD, uart_bfm
+from .util import AXISBus, timeout
 
-BAUD = 4e6
-BIT_STEPS = get_sim_steps(1 / BAUD, 'sec', round_mode='round')
+# A UART receiver sampling signal. If the simulation has a uart_sink for
+# signal, it does the sampling, and we only wake up once per frame. Otherwise,
+# we sample each bit ourselves. Received bytes are queued. frame_errors counts
+# frames with a low stop bit.
+class UARTSink:
+    def __init__(self, signal, baud=BAUD, stop_bits=1, skew=0):
+        self.signal = signal
+        self.stop_bits = stop_bits
+        self.baud = baud * (1 + skew)
+        self.queue = Queue()
+        self.frame_errors = 0
+        self.received = 0
+        self.first = None
+        self.last = None
 
-async def getchar(signals):
-    while not signals['tx'].value:
-        await FallingEdge(signals['clk'])
-    while signals['tx'].value:
-        await FallingEdge(signals['clk'])
-    await Timer(BIT_STEPS // 2)
+        self.bfm = uart_bfm(signal)
+        if self.bfm is not None:
+            self.bfm.period.value = 1e9 / self.baud
+            self.bfm.stop_bits.value = stop_bits
+            self.bfm.enable.value = 1
+        self.task = cocotb.start_soon(self.run())
 
-    result = 0
-    for _ in range(8):
-        await Timer(BIT_STEPS)
-        result >>= 1
-        result |= 0x80 if signals['tx'].value else 0
+    async def sample(self):
+        if self.bfm is not None:
+            await Edge(self.bfm.done)
+            return int(self.bfm.data.value), bool(self.bfm.frame_error.value)
 
-    await Timer(BIT_STEPS)
-    assert signals['tx'].value
-    return result
+        steps = get_sim_steps(1, 'sec') / self.baud
+        await FallingEdge(self.signal)
+        start = get_sim_time()
+        c = 0
+        for bit in range(8):
+            await Timer(round(start + (bit + 1.5) * steps) - get_sim_time())
+            c |= int(self.signal.value) << bit
 
-@timeout(50, 'us')
+        frame_error = False
+        for bit in range(self.stop_bits):
+            await Timer(round(start + (bit + 9.5) * steps) - get_sim_time())
+            frame_error |= not self.signal.value
+        return c, frame_error
+
+    async def run(self):
+        while True:
+            c, frame_error = await self.sample()
+            self.last = get_sim_time('sec')
+            if self.first is None:
+                self.first = self.last
+            self.received += 1
+            self.frame_errors += frame_error
+            self.queue.put_nowait(c)
+
+    async def getchar(self):
+        return await self.queue.get()
+
+    async def recv(self, count):
+        return bytes([await self.getchar() for _ in range(count)])
+
+    # Bytes per second between the first and last frames
+    def rate(self):
+        if self.received < 2 or self.last == self.first:
+            return 0
+        return (self.received - 1) / (self.last - self.first)
+
+    def kill(self):
+        self.task.kill()
+
+@timeout(3, 'ms')
 async def test_tx(uart, ratio):
     uart.clk.value = BinaryValue('Z')
     uart.rst.value = 1
@@ -43,28 +91,19 @@ async def test_tx(uart, ratio):
     await cocotb.start(Clock(uart.clk, 8, units='ns').start())
     await FallingEdge(uart.clk)
 
-    msg = b"Hello"
+    msg = bytes(range(256)) * 4
 
-    axis = {
-        'clk': uart.clk,
-        'data': uart.data,
-        'valid': uart.valid,
-        'ready': uart.ready,
-    }
+    axis = AXISBus(uart)
+    sink = UARTSink(uart.tx)
 
     await cocotb.start(send_packet(axis, msg, ratio))
+    assert msg == await sink.recv(len(msg))
+    assert not sink.frame_errors
 
-    then = get_sim_time()
-    for c in msg:
-        assert c == await getchar({
-            'clk': uart.clk,
-            'tx': uart.tx,
-        })
-    now = get_sim_time()
-
-    expected = BIT_STEPS * (10 * len(msg) - 0.5)
-    actual = now - then
-    assert abs(actual - expected) / expected < 0.01
+    expected = BAUD / 10
+    print(f"{sink.rate():.0f} bytes/s")
+    assert abs(sink.rate() - expected) / expected < 0.01
+    sink.kill()
 
 uart_tests = TestFactory(test_tx)
 uart_tests.add_option('ratio', (1, int(125e6 / BAUD * 10)))
@@ -1,18 +1,21 @@
 # SPDX-License-Identifier: AGPL-3.0-Only
 # Copyright (C) 2023 Sean Anderson <seanga2@gmail.com>
 
+import random
+
 import cocotb
 from cocotb.binary import BinaryValue
 from cocotb.clock import Clock
 from cocotb.triggers import Event, FallingEdge, Timer
 
-from .axis_wb_bridge import Encoder, STATUS_WE
-from .mdio import wb_read, wb_write, wb_err
-from .uart_rx import putchar, BIT_STEPS
-from .uart_tx import getchar
+from .axis_wb_bridge import Encoder, STATUS_WE, random_commands
+from .mdio import WishboneSlave, random_xfers, wb_read, wb_write, wb_err
+from .uart_rx import UARTSource
+from .uart_tx import UARTSink
+from .util import WishboneBus, detach_all
 
-@cocotb.test(timeout_time=100, timeout_unit='us')
-async def test_bridge(bridge):
+async def setup(bridge):
+    await detach_all()
     bridge.clk.value = BinaryValue('Z')
     bridge.rst.value = 1
     bridge.rx.value = 1
@@ -25,55 +28,61 @@ async def test_bridge(bridge):
     await cocotb.start(Clock(bridge.clk, 8, units='ns').start())
     await FallingEdge(bridge.clk)
 
-    wb = {
-        'clk': bridge.clk,
-        'ack': bridge.wb_ack,
-        'err': bridge.wb_err,
-        'cyc': bridge.wb_cyc,
-        'stb': bridge.wb_stb,
-        'we': bridge.wb_we,
-        'addr': bridge.wb_addr,
-        'data_write': bridge.wb_data_write,
-        'data_read': bridge.wb_data_read,
-    }
+@cocotb.test(timeout_time=100, timeout_unit='us')
+async def test_bridge(bridge):
+    await setup(bridge)
+
+    wb = WishboneBus(bridge, 'wb_')
 
     e = Encoder()
     recv_ready = Event()
-
-    async def send_break():
-        bridge.rx.value = 0
-        await Timer(BIT_STEPS * 20)
-        bridge.rx.value = 1
-        await Timer(BIT_STEPS)
+    source = UARTSource(bridge.rx)
+    sink = UARTSink(bridge.tx)
 
     async def send():
-        for c in e.encode(0x0123, 0x4567):
-            await putchar(bridge.rx, c)
+        await source.send(e.encode(0x0123, 0x4567))
 
         # Start a read
         await recv_ready.wait()
-        await putchar(bridge.rx, e.encode(0xdead)[0])
+        await source.send(e.encode(0xdead)[:1])
         # Cancel it
-        await send_break()
+        await source.send_break()
 
         # And do another read
         e.last_addr = None
-        for c in e.encode(0x89ab):
-            await putchar(bridge.rx, c)
+        await source.send(e.encode(0x89ab))
 
     await cocotb.start(send())
     await cocotb.start(wb_write(wb, 0x0123, 0x4567))
 
-    uart = {
-        'clk': bridge.clk,
-        'tx': bridge.tx,
-    }
-
-    assert await getchar(uart) == STATUS_WE
+    assert await sink.getchar() == STATUS_WE
 
     recv_ready.set()
     await cocotb.start(wb_read(wb, 0x89ab, 0xcdef))
 
-    assert await getchar(uart) == 0
-    assert await getchar(uart) == 0xcd
-    assert await getchar(uart) == 0xef
+    assert await sink.recv(3) == bytes((0, 0xcd, 0xef))
+    assert not sink.frame_errors
+    sink.kill()
+
+@cocotb.test(timeout_time=3000, timeout_unit='us')
+async def test_random(bridge):
+    await setup(bridge)
+
+    slave = WishboneSlave(WishboneBus(bridge, 'wb_'), wait_states=lambda: random.randrange(3),
+                          errors=(range(0xff00, 0x10000),))
+    source = UARTSource(bridge.rx)
+    sink = UARTSink(bridge.tx)
+
+    addrs = [0x1200 | random.randrange(0x100) for _ in range(8)]
+    addrs += [random.randrange(0xff00) for _ in range(7)] + [0xffff]
+    xfers = list(random_xfers(slave, addrs, 100))
+
+    # There's no flow control, so wait for each response before sending the
+    # next command
+    for cmd, resp in random_commands(xfers):
+        await source.send(cmd)
+        assert await sink.recv(len(resp)) == bytes(resp)
+
+    assert slave.log == [(addr, data, err) for addr, data, _, err in xfers]
+    assert not sink.frame_errors
+    sink.kill()
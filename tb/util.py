@@ -2,13 +2,17 @@
 # Copyright (C) 2022 Sean Anderson <seanga2@gmail.com>
 
 import functools
+from fractions import Fraction
 import itertools
 import random
 
 import cocotb
+from cocotb import simulator
+from cocotb.handle import SimHandle
 from cocotb.result import SimTimeoutError
-from cocotb.triggers import ClockCycles, FallingEdge, with_timeout
+from cocotb.triggers import ClockCycles, FallingEdge, RisingEdge, Timer, with_timeout
 from cocotb.types import LogicArray
+from cocotb.utils import get_sim_time
 
 async def alist(xs):
     return [x async for x in xs]
@@ -23,6 +27,26 @@ def BIT(n):
 def GENMASK(h, l):
     return (-1 << l) & ((1 << h + 1) - 1)
 
+# Bit streams are packed into integers with the first bit in the LSB. Since the
+# length can't be recovered from the integer alone, they are passed around as
+# (value, length) pairs.
+_BITS_TO_CHARS = bytes.maketrans(b'\0\1', b'01')
+_CHARS_TO_BITS = bytes.maketrans(b'01', b'\0\1')
+
+def str_to_bits(s):
+    return int(s[::-1] or '0', 2), len(s)
+
+def bits_to_str(value, length):
+    if not length:
+        return ''
+    return format(value & GENMASK(length - 1, 0), f"0{length}b")[::-1]
+
+def pack_bits(bits):
+    return str_to_bits(bytes(map(int, bits)).translate(_BITS_TO_CHARS).decode())
+
+def unpack_bits(value, length):
+    return list(bits_to_str(value, length).encode().translate(_CHARS_TO_BITS))
+
 # From https://stackoverflow.com/a/7864317/5086505
 class classproperty(property):
     def __get__(self, cls, owner):
@@ -79,6 +103,115 @@ class ReverseList(list):
     def __iter__(self):
         return super().__reversed__()
 
+class Pipeline:
+    def __init__(self, *stages):
+        self.stages = stages
+
+    def __call__(self, *chunk):
+        for stage in self.stages:
+            chunk = stage(*chunk)
+        return chunk
+
+# Sample signal on each rising edge of clk, and yield the samples as packed
+# (value, length) chunks of size bits. This still wakes up for every bit; only
+# the processing of the samples (e.g. by a Pipeline) is batched. Because
+# nothing is decoded until a chunk is full, recv_frames yields each frame up to
+# size - 1 clocks after its last bit was sampled. Pass a smaller size if that
+# latency matters.
+async def recv_chunks(clk, signal, size=32):
+    edge = RisingEdge(clk)
+    while True:
+        samples = []
+        for _ in range(size):
+            await edge
+            samples.append(signal.value)
+        yield pack_bits(samples)
+
+async def recv_frames(clk, signal, pipeline, size=32):
+    async for chunk in recv_chunks(clk, signal, size):
+        for frame in pipeline(*chunk):
+            yield frame
+
+# A fixed-width shift register. Bits are shifted in at bit 0, and slices select
+# fields like in Verilog (e.g. [4:0] is the five most-recent bits).
+class ShiftRegister:
+    __slots__ = ('value', 'mask')
+
+    def __init__(self, width, value=0):
+        self.mask = GENMASK(width - 1, 0)
+        self.value = value & self.mask
+
+    def append(self, bit):
+        self.value = (self.value << 1 | int(bit)) & self.mask
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return (self.value >> key.stop) & GENMASK(key.start - key.stop, 0)
+        return (self.value >> key) & 1
+
+    def all(self, h, l):
+        return not ~self.value & GENMASK(h, l)
+
+    def any(self, h, l):
+        return bool(self.value & GENMASK(h, l))
+
+# A group of signals, looked up once when the bus is created. Each signal is
+# named prefix + name + suffix, unless it is passed as a keyword argument
+# (either as a handle or as a name). Optional signals which don't exist are
+# None.
+class Bus:
+    __slots__ = ('clk',)
+    signals = ()
+    optional = ()
+
+    def __init__(self, dut, prefix='', suffix='', *, clk='clk', **signals):
+        self.clk = getattr(dut, clk) if isinstance(clk, str) else clk
+        for name in self.signals + self.optional:
+            handle = signals.pop(name, f"{prefix}{name}{suffix}")
+            if isinstance(handle, str):
+                if name in self.optional:
+                    handle = getattr(dut, handle, None)
+                else:
+                    handle = getattr(dut, handle)
+            setattr(self, name, handle)
+
+        if signals:
+            raise TypeError(f"Unknown signals {', '.join(signals)}")
+
+class AXISBus(Bus):
+    signals = ('data', 'valid', 'ready')
+    optional = ('last', 'err')
+    __slots__ = signals + optional
+
+class MIIBus(Bus):
+    signals = ('ce', 'data')
+    optional = ('enable', 'valid', 'err')
+    __slots__ = signals + optional
+
+class WishboneBus(Bus):
+    signals = ('stb', 'we', 'addr', 'data_write', 'data_read', 'ack', 'err')
+    optional = ('cyc',)
+    __slots__ = signals + optional
+
+# LogicArrays are slow to create, so build each value once and share it. They
+# are keyed by (width, pattern), where pattern is repeated width times. The
+# values are shared, so don't modify them.
+_logic_values = {}
+
+def logic_value(pattern, width=1):
+    key = (width, pattern)
+    value = _logic_values.get(key)
+    if value is None:
+        value = _logic_values[key] = LogicArray(pattern * width)
+    return value
+
+# All possible values of the data input for send_recovered_bits
+RECOVERED_BITS = {
+    (first, second): LogicArray((first, second))
+    for first in (0, 1, 'X')
+    for second in (0, 1, 'X')
+}
+
 def one_valid():
     return itertools.repeat(1)
 
@@ -92,6 +225,23 @@ def rand_valid():
 def saw_valid():
     return itertools.cycle(range(3))
 
+# Patterns for AXI stream valid and ready signals. Each returns an iterator
+# saying whether the signal should be high on each successive cycle.
+def always_high():
+    return itertools.repeat(1)
+
+def rand_high():
+    while True:
+        yield random.randrange(2)
+
+def burst_high(on=8, off=8):
+    return itertools.cycle((1,) * on + (0,) * off)
+
+def saw_high(period=4):
+    return itertools.cycle(itertools.chain.from_iterable((1,) * n + (0,) for n in range(period)))
+
+AXIS_PATTERNS = (always_high, rand_high, burst_high, saw_high)
+
 def with_valids(g, f):
     for valids in (one_valid, two_valid, rand_valid, saw_valid):
         async def test(*args, valids=valids, **kwargs):
@@ -107,7 +257,7 @@ async def send_recovered_bits(clk, data, valid, bits, valids):
     try:
         for v in valids():
             if v == 0:
-                d = 'XX'
+                d = ('X', 'X')
             elif v == 1:
                 d = (next(bits), 'X')
             else:
@@ -118,7 +268,7 @@ async def send_recovered_bits(clk, data, valid, bits, valids):
                     second = 'X'
                     v = 1
                 d = (first, second)
-            data.value = LogicArray(d)
+            data.value = RECOVERED_BITS[d]
             valid.value = v
             await FallingEdge(clk)
     except StopIteration:
@@ -127,25 +277,208 @@ async def send_recovered_bits(clk, data, valid, bits, valids):
 def print_list_at(l, i):
     print(' ' * max(50 - i, 0), *l[max(i - 50, 0):i+50], sep='')
 
+def mismatches(ins, outs):
+    length = min(len(ins), len(outs))
+    try:
+        diff = pack_bits(ins[:length])[0] ^ pack_bits(outs[:length])[0]
+    except (TypeError, ValueError):
+        # Not a bit stream (or it has Xs in it)
+        return [idx for idx, (i, o) in enumerate(zip(ins, outs)) if i != o]
+
+    diff = bits_to_str(diff, length)
+    idxs = []
+    idx = diff.find('1')
+    while idx >= 0:
+        idxs.append(idx)
+        idx = diff.find('1', idx + 1)
+    return idxs
+
 def compare_lists(ins, outs):
     assert outs
-    for idx, (i, o) in enumerate(zip(ins, outs)):
-        if i != o:
-            print(idx)
-            print_list_at(ins, idx)
-            print_list_at(outs, idx)
-            assert False, "Differring bit"
-
-async def ClockEnable(clk, ce, ratio):
-    ce.value = 1
-    if ratio == 1:
-        return
+    idxs = mismatches(ins, outs)
+    if idxs:
+        print(len(idxs), "differing bits at", *idxs[:100])
+        print_list_at(ins, idxs[0])
+        print_list_at(outs, idxs[0])
+        assert False, "Differring bit"
 
-    while True:
-        await ClockCycles(clk, 1)
-        ce.value = 0
-        await ClockCycles(clk, ratio - 1)
-        ce.value = 1
+# Find the offset into ins which best matches outs, and the number of
+# matching bits at that offset.
+def align(ins, outs, offsets):
+    ins, ins_len = pack_bits(ins)
+    outs, outs_len = pack_bits(outs)
+
+    best_corr = -1
+    best_off = None
+    for off in offsets:
+        length = max(min(ins_len - off, outs_len), 0)
+        corr = length - ((ins >> off ^ outs) & GENMASK(length - 1, 0)).bit_count()
+        if corr > best_corr:
+            best_corr = corr
+            best_off = off
+    return best_off, best_corr
+
+# The HDL drivers in rtl/clock_enables.v and rtl/uart_bfms.v force their
+# inputs from when they are attached until they are detached, even after the
+# test which attached them has finished. Keep track of them by input name.
+attached = {}
+
+# Detach the drivers left attached by earlier tests. The release takes effect
+# after the write, so wait a step before driving their inputs.
+async def detach_all():
+    if attached:
+        for driver in list(attached.values()):
+            driver.detach()
+        await Timer(1)
+
+# A clock enable which goes high once every ratio cycles, starting now. ratio
+# may be a Fraction (or anything which can be converted to one), in which case
+# the strobes are spread out using a phase accumulator. If the simulation has a
+# generator in rtl/clock_enables.v for ce, then ce is driven from the HDL and
+# we only need to reconfigure it. Otherwise, ce is toggled from Python. Once
+# started, ce should only be driven with set() until it is detached.
+class ClockEnable:
+    def __init__(self, clk, ce, ratio, phase=0):
+        self.clk = clk
+        self.ce = ce
+        self.task = None
+        self.generator = None
+
+        root = simulator.get_root_handle('clock_enables')
+        if root:
+            self.generator = getattr(SimHandle(root), ce._name, None)
+        self.start(ratio, phase)
+
+    # Restart with a new ratio. phase is how many cycles the next strobe is
+    # brought forward by.
+    def start(self, ratio, phase=0):
+        ratio = Fraction(ratio)
+        step = ratio.denominator
+        ratio = ratio.numerator
+        count = phase * step
+
+        if self.generator is None:
+            self.kill()
+            self.ce.value = 1
+            if ratio > step:
+                self.task = cocotb.start_soon(self.toggle(ratio, step, count))
+            return
+
+        self.generator.ratio.value = ratio
+        self.generator.step.value = step
+        self.generator.count.value = count
+        self.generator.strobe.value = 1
+        self.generator.enable.value = 1
+        self.attach()
+
+    def attach(self):
+        self.generator.attach.value = 1
+        attached[self.ce._name] = self
+
+    async def toggle(self, ratio, step, count):
+        while True:
+            cycles = max((ratio - count + step - 1) // step, 1)
+            await ClockCycles(self.clk, 1)
+            self.ce.value = 0
+            if cycles > 1:
+                await ClockCycles(self.clk, cycles - 1)
+            self.ce.value = 1
+            count += cycles * step - ratio
+
+    # Stop strobing and hold ce at value
+    def set(self, value):
+        if self.generator is None:
+            self.kill()
+            self.ce.value = value
+            return
+
+        self.generator.hold.value = value
+        self.generator.enable.value = 0
+        self.attach()
+
+    # Stop strobing, leaving ce where it is
+    def kill(self):
+        if self.generator is None:
+            if self.task is not None:
+                self.task.kill()
+                self.task = None
+        else:
+            self.set(self.generator.ce.value)
+
+    # Stop driving ce altogether, so it can be written directly again
+    def detach(self):
+        if self.generator is None:
+            self.kill()
+        elif attached.pop(self.ce._name, None) is not None:
+            self.generator.attach.value = 0
+
+# A registry of the counters used by a test, keyed by name
+class Metrics(dict):
+    def counts(self):
+        return {name: counter.count for name, counter in self.items()}
+
+    def reset(self):
+        for counter in self.values():
+            counter.reset()
+
+    def report(self):
+        for name, counter in self.items():
+            print(f"{name}: {counter.count}")
+
+# Count edges of signal, waking up only when they happen. If timestamps is set,
+# the time (in ns) of each edge is recorded in times. If metrics is given, the
+# counter is registered there under name (or the signal's name).
+class EdgeCounter:
+    def __init__(self, signal, edge=RisingEdge, *, timestamps=False, metrics=None, name=None):
+        self.signal = signal
+        self.edge = edge
+        self.times = [] if timestamps else None
+        self.reset()
+        if metrics is not None:
+            metrics[signal._name if name is None else name] = self
+        self.task = cocotb.start_soon(self.run())
+
+    def reset(self):
+        self.count = 0
+        if self.times is not None:
+            self.times.clear()
+
+    def record(self):
+        self.count += 1
+        if self.times is not None:
+            self.times.append(get_sim_time('ns'))
+
+    def kill(self):
+        self.task.kill()
+
+    async def run(self):
+        edge = self.edge(self.signal)
+        while True:
+            await edge
+            self.record()
+
+# Count the cycles of clk where signal is high. It is sampled on the falling
+# edge of clk, but only while it is high. If edges is set, only count the
+# cycles where it goes high, so each run of high cycles counts once. Unlike
+# EdgeCounter, glitches between clock edges are never counted.
+class StrobeCounter(EdgeCounter):
+    def __init__(self, clk, signal, *, edges=False, **kwargs):
+        self.clk = clk
+        self.edges = edges
+        super().__init__(signal, **kwargs)
+
+    async def run(self):
+        rising = RisingEdge(self.signal)
+        falling = FallingEdge(self.clk)
+        while True:
+            await falling
+            high = False
+            while self.signal.value:
+                if not (high and self.edges):
+                    self.record()
+                high = True
+                await falling
+            await rising
 
 # Adapted from https://stackoverflow.com/a/1630350/5086505
 def lookahead(it):
@@ -1,13 +1,16 @@
 # SPDX-License-Identifier: AGPL-3.0-Only
 # Copyright (C) 2023 Sean Anderson <seanga2@gmail.com>
 
+import random
+
 import cocotb
 from cocotb.binary import BinaryValue
 from cocotb.clock import Clock
 from cocotb.triggers import FallingEdge, RisingEdge, Timer
 
-from .mdio import wb_read, wb_write, wb_err
-from .mdio_regs import wb_xfer
+from .mdio import WishboneSlave, random_xfers, wb_read, wb_write, wb_err
+from .mdio_regs import WishboneMaster, wb_xfer
+from .util import WishboneBus
 
 @cocotb.test(timeout_time=50, timeout_unit='us')
 async def test_reg(reg):
@@ -22,29 +25,8 @@ async def test_reg(reg):
     await cocotb.start(Clock(reg.clk, 8, units='ns').start())
     await FallingEdge(reg.clk)
 
-    master = {
-        'clk': reg.clk,
-        'ack': reg.m_ack,
-        'err': reg.m_err,
-        'cyc': reg.m_cyc,
-        'stb': reg.m_stb,
-        'we': reg.m_we,
-        'addr': reg.m_addr,
-        'data_write': reg.m_data_write,
-        'data_read': reg.m_data_read,
-    }
-
-    slave = {
-        'clk': reg.clk,
-        'ack': reg.s_ack,
-        'err': reg.s_err,
-        'cyc': reg.s_cyc,
-        'stb': reg.s_stb,
-        'we': reg.s_we,
-        'addr': reg.s_addr,
-        'data_write': reg.s_data_write,
-        'data_read': reg.s_data_read,
-    }
+    master = WishboneBus(reg, 'm_')
+    slave = WishboneBus(reg, 's_')
 
     async def resp():
         await wb_read(master, 0x0123, 0x4567)
@@ -66,3 +48,27 @@ async def test_reg(reg):
     assert not reg.m_stb.value
     assert not reg.s_ack.value
     assert not reg.s_err.value
+
+@cocotb.test(timeout_time=100, timeout_unit='us')
+async def test_random(reg):
+    reg.clk.value = BinaryValue('Z')
+    reg.rst.value = 0
+    reg.s_cyc.value = 1
+    reg.s_stb.value = 0
+
+    await Timer(1)
+    await cocotb.start(Clock(reg.clk, 8, units='ns').start())
+    await FallingEdge(reg.clk)
+
+    slave = WishboneSlave(WishboneBus(reg, 'm_'), wait_states=lambda: random.randrange(3),
+                          errors=(range(0xff00, 0x10000),))
+    master = WishboneMaster(WishboneBus(reg, 's_'))
+
+    addrs = random.sample(range(0xff00), 63) + [0xffff]
+    xfers = list(random_xfers(slave, addrs, 1000))
+    txns = [master.submit(addr, data) for addr, data, _, _ in xfers]
+    await txns[-1].done.wait()
+
+    assert [(txn.result, txn.err) for txn in txns] == \
+        [(result, err) for _, _, result, err in xfers]
+    assert slave.log == [(addr, data, err) for addr, data, _, err in xfers]